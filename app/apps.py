@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class AppsConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        from logic import intsteps, stepstore
+        from logic.pool import WorkerPool
+        stepstore.configure(getattr(settings, 'STEP_STORE_PATH', None))
+        intsteps.default_budget = getattr(settings, 'INTSTEPS_BUDGET', None)
+        intsteps.max_budget = getattr(settings, 'INTSTEPS_MAX_BUDGET', None)
+        processes = getattr(settings, 'INTSTEPS_WORKER_PROCESSES', 0)
+        intsteps.worker_pool = WorkerPool(processes=processes) \
+            if processes else None
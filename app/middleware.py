@@ -0,0 +1,42 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+
+from logic import timing
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTimingMiddleware(object):
+    """
+    Time the stages of each request (see logic.timing) and send them in a
+    Server-Timing header with the total, and log them if SERVER_TIMING_LOG.
+
+    Streamed responses only count the time to start the stream.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        send = getattr(settings, 'SERVER_TIMING', False)
+        log = getattr(settings, 'SERVER_TIMING_LOG', False)
+        if not (send or log):
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        with timing.collect() as timings:
+            response = self.get_response(request)
+        timings.add('total', time.perf_counter() - start)
+
+        if send:
+            response['Server-Timing'] = timings.header()
+        if log:
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'ms': timings.milliseconds(),
+            }))
+        return response
@@ -0,0 +1,105 @@
+"""
+Write the step-by-step HTML of the example inputs to steps.json, which
+StepsRegressionTestCase compares the printers' output with. Only
+regenerate it for intended changes to the printed steps.
+
+Run from the repository root with
+``python -m app.testdata.generate_steps``.
+"""
+import json
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mathtutor.settings')
+
+import django
+django.setup()
+
+import sympy
+
+from app.views import HOME_PAGE_EXAMPLES
+from logic import diffsteps, intsteps
+from logic.logic import UserInput
+
+PATH = os.path.join(os.path.dirname(__file__), 'steps.json')
+
+PRINTERS = {
+    'diffsteps': diffsteps.print_html_steps,
+    'intsteps': intsteps.print_html_steps,
+}
+
+# Nested chain rules and substitutions, on top of the home page examples
+EXTRA_EXAMPLES = [
+    'diff(tan(sin(x)), x)',
+    'diff(sin(cos(x)^2), x)',
+    'diff(exp(sin(x^2)), x)',
+    'diff(log(cos(x))^3, x)',
+    'diff(x*cos(x)*sin(x)*tan(x), x)',
+    'integrate(x*exp(x^2), x)',
+    'integrate(sin(x)*cos(x), x)',
+    'integrate(cos(x)*exp(sin(x)), x)',
+    'integrate(x/(x^2+1), x)',
+    'integrate(exp(2x) / (1 + exp(x)), x)',
+    'integrate(sec(x)^2 * tan(x), x)',
+    'integrate(sin(x)^3*cos(x), x)',
+    'integrate(2x*cos(x^2), x)',
+    'integrate(x*sqrt(x^2+1), x)',
+    'integrate(x*sin(x), x)',
+    'integrate(x*exp(x), x)',
+    'integrate(log(x), x)',
+    'diff(sqrt(1 + x^2))',
+    'diff(cot(y), y)',
+    'diff(sin(x)^cos(x), x)',
+    'diff(x^4 / (1 + (tan(sin(x))))^2)',
+    'diff(csc(x^2)*sec(x), x)',
+]
+
+
+def examples():
+    for _, groups in HOME_PAGE_EXAMPLES:
+        for _, group in groups:
+            for example in group:
+                yield example[1] if isinstance(example, tuple) else example
+    for example in EXTRA_EXAMPLES:
+        yield example
+
+
+def step_cases():
+    """(kind, expression, symbol) for each step card of the examples."""
+    seen = set()
+    for example in examples():
+        for card in UserInput().change_to_cards(example) or []:
+            if card.get('card') not in PRINTERS:
+                continue
+            evaluator, components = UserInput().prepare_card_evaluation(
+                example, card['var'])
+            if card['card'] == 'diffsteps':
+                expr = components.get('function',
+                                      evaluator.get('input_evaluated'))
+            else:
+                expr = components.get('integrand',
+                                      evaluator.get('input_evaluated'))
+            case = (card['card'], sympy.srepr(expr),
+                    sympy.srepr(components['variable']))
+            if case not in seen:
+                seen.add(case)
+                yield case
+
+
+def main():
+    cases = []
+    for kind, expr, symbol in step_cases():
+        case = {'kind': kind, 'expr': expr, 'symbol': symbol}
+        try:
+            case['html'] = PRINTERS[kind](sympy.sympify(expr),
+                                          sympy.sympify(symbol))
+        except Exception as e:
+            case['error'] = '{}: {}'.format(type(e).__name__, e)
+        cases.append(case)
+    with open(PATH, 'w') as f:
+        json.dump(cases, f, indent=1, sort_keys=True)
+        f.write('\n')
+    print('{} cases written to {}'.format(len(cases), PATH))
+
+
+if __name__ == '__main__':
+    main()
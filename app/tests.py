@@ -1,9 +1,55 @@
-from django.test import TestCase
-from logic.utils import Eval
+from django import test
+from logic.utils import Eval, Namespace, SYMPY_NAMESPACE, DEFERRED_CALLS, \
+    arguments, evaluate_input
+from logic.cache import LRUCache
+from logic.logic import UserInput, card_cache
+from logic import diffsteps, intsteps, latexcache, numeric, stepstore, \
+    timing
+from logic.pool import WorkerPool, WorkerTimeout
+from logic.simplification import likely_to_shrink
+from logic.resultsets import analyze_expression, extract_integral, \
+    find_result_set
+from chatbot.tokenizers import punkt_available
+from concurrent.futures import ThreadPoolExecutor
+from app import views
+import importlib
+import itertools
 import json
+import numpy
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import sympy
 from django.urls import reverse
 
 
+def setUpModule():
+    global store_directory
+    store_directory = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    stepstore.configure(None)
+    shutil.rmtree(store_directory)
+
+
+class TestCase(test.TestCase):
+    """
+    Starts every test with an empty step store in a temporary file, so that
+    steps stored by an earlier run or test can't hide a change.
+    """
+    def setUp(self):
+        super().setUp()
+        stepstore.configure(
+            os.path.join(store_directory, 'steps.sqlite3')).clear()
+
+
 class ViewTestCase(TestCase):
 
     def setUp(self):
@@ -167,3 +213,958 @@ class TestEval(TestCase):
     a
     """
                       ).startswith("Traceback")
+
+
+class LRUCacheTestCase(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_evicts_by_size(self):
+        cache = LRUCache(max_entries=10, max_bytes=10, sizeof=len)
+        cache.set('a', 'xxxxxx')
+        cache.set('b', 'xxxxxx')
+
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 6)
+
+    def test_equivalent_inputs_share_cards(self):
+        """
+        Inputs that only differ in spacing or notation hit the same entry.
+        """
+        card_cache.clear()
+        first = UserInput().change_to_cards('diff(x^2, x)')
+        hits = card_cache.stats()['hits']
+        second = UserInput().change_to_cards('diff( x**2 ,x)')
+
+        self.assertEqual(first, second)
+        self.assertEqual(card_cache.stats()['hits'], hits + 1)
+
+    def test_miss_stringifies_once(self):
+        card_cache.clear()
+        normalize_input = UserInput.normalize_input
+        with mock.patch.object(UserInput, 'normalize_input', autospec=True,
+                               side_effect=normalize_input) as normalize:
+            UserInput().change_to_cards('diff(x^2, x)')
+        self.assertEqual(normalize.call_count, 1)
+
+
+class StepStoreTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'steps.sqlite3')
+        self.calls = []
+
+    def tearDown(self):
+        stepstore.configure(None)
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def compute(self, expr, symbol):
+        self.calls.append(expr)
+        return '<ol>{}</ol>'.format(expr)
+
+    def test_steps_survive_a_new_store(self):
+        x = sympy.Symbol('x')
+        stepstore.configure(self.path)
+        first = stepstore.cached_steps('diffsteps', '1', x**2, x, self.compute)
+        stepstore.configure(self.path)
+        second = stepstore.cached_steps('diffsteps', '1', x**2, x, self.compute)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_new_version_recomputes(self):
+        x = sympy.Symbol('x')
+        stepstore.configure(self.path)
+        stepstore.cached_steps('diffsteps', '1', x**2, x, self.compute)
+        stepstore.cached_steps('diffsteps', '2', x**2, x, self.compute)
+
+        self.assertEqual(len(self.calls), 2)
+
+    def test_partial_steps_are_not_stored(self):
+        x = sympy.Symbol('x')
+        stepstore.configure(self.path)
+
+        def compute(expr, symbol, on_flush=None):
+            self.calls.append(expr)
+            return stepstore.Partial('<ol>{}</ol>'.format(expr))
+
+        stepstore.cached_steps('intsteps', '1', x**2, x, compute)
+        stepstore.cached_steps('intsteps', '1', x**2, x, compute)
+        list(stepstore.stream_cached_steps('intsteps', '1', x**2, x, compute))
+
+        self.assertEqual(len(self.calls), 3)
+
+
+class NamespaceTestCase(TestCase):
+    def test_names_do_not_leak_between_requests(self):
+        first, second = Eval(Namespace()), Eval(Namespace())
+        first.eval("sin = 5")
+
+        self.assertEqual(first.eval("sin"), "5")
+        self.assertEqual(second.eval("sin(0)"), "0")
+        self.assertIs(SYMPY_NAMESPACE['sin'], sympy.sin)
+
+    def test_functions_see_sympy_names(self):
+        e = Eval(Namespace())
+        self.assertEqual(e.eval("def f(x):\n\treturn sin(x)\nf(0)"), "0")
+
+
+class EvaluateInputTestCase(TestCase):
+    def test_matches_separate_evaluation(self):
+        """
+        The single pass gives the same arguments and result as evaluating
+        the input and its arguments separately.
+        """
+        for s in ("diff(cos(x)**7, x)", "integrate(1/x, x)", "x**2 + sin(x)",
+                  "factorint(Integer(12))", "x"):
+            namespace = Namespace()
+            evaluator = Eval(namespace)
+            parsed = UserInput().normalize_input(s, namespace)
+
+            args, evaluated = evaluate_input(parsed, evaluator)
+            if args.function in DEFERRED_CALLS:
+                evaluated = evaluated.doit()
+            self.assertEqual((args, evaluated),
+                             (arguments(parsed, evaluator),
+                              evaluator.eval(parsed, repr_expression=False)))
+
+
+class ResultSetTestCase(TestCase):
+    def test_analyze_expression(self):
+        x = sympy.Symbol('x')
+        features = analyze_expression(x * sympy.cos(sympy.log(x)))
+
+        self.assertIs(features.head, sympy.Mul)
+        self.assertIn(sympy.cos, features.types)
+        self.assertIn(sympy.log, features.types)
+        self.assertEqual(features.free_symbols, {x})
+        self.assertFalse(features.is_constant)
+
+    def test_find_result_set_keeps_order(self):
+        x = sympy.Symbol('x')
+        converter, cards = find_result_set('integrate', sympy.sin(x))
+
+        self.assertIs(converter, extract_integral)
+        self.assertEqual(cards, ['integral_numeric',
+                                 'integral_alternate_fake', 'intsteps',
+                                 'trig_alternate', 'diff',
+                                 'integral_alternate'])
+
+    def test_find_result_set_stops_at_none(self):
+        x = sympy.Symbol('x')
+        self.assertEqual(find_result_set('rsolve', sympy.sin(x))[1], [])
+
+
+def _sleep_and_return(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def _raise_value_error(message):
+    raise ValueError(message)
+
+
+def _latex_in_worker(expr):
+    return latexcache.latex(expr, 'worker')
+
+
+class WorkerPoolTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = WorkerPool(processes=1, timeout=2)
+
+    def tearDown(self):
+        self.pool.close()
+        super().tearDown()
+
+    def test_apply(self):
+        self.assertEqual(self.pool.apply(_sleep_and_return, 0, 'done'), 'done')
+
+    def test_errors_are_raised_in_caller(self):
+        with self.assertRaises(ValueError):
+            self.pool.apply(_raise_value_error, 'bad input')
+
+    def test_runaway_worker_is_replaced(self):
+        with self.assertRaises(WorkerTimeout):
+            self.pool.apply(_sleep_and_return, 10, 'late')
+        self.assertEqual(self.pool.apply(_sleep_and_return, 0, 'done'), 'done')
+
+    def test_waiting_for_a_worker_counts_against_the_timeout(self):
+        with ThreadPoolExecutor(1) as threads:
+            busy = threads.submit(self.pool.apply, _sleep_and_return, 1, 'busy')
+            time.sleep(0.2)
+            start = time.monotonic()
+            with self.assertRaises(WorkerTimeout):
+                self.pool.apply(_sleep_and_return, 0, 'late', timeout=0.3)
+            self.assertLess(time.monotonic() - start, 0.6)
+            self.assertEqual(busy.result(), 'busy')
+
+    def test_worker_replaced_while_a_thread_holds_a_lock(self):
+        held, release = threading.Event(), threading.Event()
+
+        def hold():
+            # latexcache.latex takes this lock to count the call
+            with latexcache._site_lock:
+                held.set()
+                release.wait()
+
+        self.pool.start()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        try:
+            with self.assertRaises(WorkerTimeout):
+                self.pool.apply(_sleep_and_return, 10, 'late')
+        finally:
+            release.set()
+            thread.join()
+        x = sympy.Symbol('x')
+        self.assertEqual(self.pool.apply(_latex_in_worker, x**2), 'x^{2}')
+
+    def test_took_too_long_card(self):
+        card_cache.clear()
+        self.pool.timeout = 0.001
+        cards = UserInput(pool=self.pool).change_to_cards('integrate(x*sin(x))')
+
+        self.assertEqual(cards[1]['error'], "This took too long to compute.")
+        self.assertEqual(len(card_cache), 0)
+
+
+class BatchCardTestCase(TestCase):
+    def test_batch_matches_single_cards(self):
+        """
+        The batch endpoint returns what each card's own endpoint returns.
+        """
+        expression = 'integrate(x*sin(x), x)'
+        response = self.client.post('/cards/', data=json.dumps({
+            'expression': expression,
+            'variable': 'x',
+            'cards': [
+                {'name': 'intsteps', 'parameters': {}},
+                {'name': 'integral_alternate_fake', 'parameters': {}},
+            ]
+        }), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        cards = response.json()['cards']
+        for name, result in zip(['intsteps', 'integral_alternate_fake'], cards):
+            single = self.client.get('/card/' + name, {
+                'expression': expression, 'variable': 'x'})
+            self.assertEqual(result, single.json())
+
+    def test_unknown_card(self):
+        results = UserInput().evaluate_cards([('nonexistent', {})],
+                                             'diff(x^2)', 'x')
+        self.assertIn('error', results[0])
+
+    def test_get_not_allowed(self):
+        response = self.client.get('/cards/')
+        self.assertEqual(response.status_code, 405)
+
+
+class StreamCardTestCase(TestCase):
+    def test_stream_matches_card(self):
+        """
+        Joining the streamed chunks gives the card's step output.
+        """
+        expression = 'diff(x*sin(x)*cos(x), x)'
+        response = self.client.get('/card/diffsteps/stream', {
+            'expression': expression, 'variable': 'x'})
+        lines = [json.loads(line) for line in
+                 b''.join(response.streaming_content).decode().splitlines()]
+
+        self.assertEqual(lines[-1], {'done': True})
+        self.assertGreater(len(lines), 2)
+        html = ''.join(line['output'] for line in lines[:-1])
+
+        single = self.client.get('/card/diffsteps', {
+            'expression': expression, 'variable': 'x'})
+        self.assertEqual('<div class="steps">' + html + '</div>',
+                         single.json()['output'])
+
+    def test_stream_base_exception(self):
+        from logic.stepprinter import stream_steps
+
+        def print_steps(on_flush):
+            on_flush('<ol>')
+            raise KeyboardInterrupt
+
+        steps = stream_steps(print_steps)
+        self.assertEqual(next(steps), '<ol>')
+        with self.assertRaises(KeyboardInterrupt):
+            next(steps)
+
+    def test_stream_error(self):
+        response = self.client.get('/card/diffsteps/stream', {
+            'expression': 'diff(x^^2)', 'variable': 'x'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertIn('error', json.loads(lines[-1]))
+
+
+class NumpyModelTestCase(TestCase):
+    def test_same_intents_as_keras(self):
+        """
+        The exported model picks the same intents as the Keras model for
+        every training pattern.
+        """
+        from keras.models import load_model
+        from chatbot import chat
+        from chatbot.numpy_model import NumpyModel
+
+        model_dir = 'chatbot/chatbot_model/'
+        keras_model = load_model(model_dir + 'chatbot_model.h5')
+        numpy_model = NumpyModel.load(model_dir + 'chatbot_model.npz',
+                                      model_dir + 'chatbot_model.json')
+
+        patterns = [pattern for intent in chat.intents['intents']
+                    for pattern in intent['patterns']]
+        bags = chat.return_bags_of_words(patterns, numpy_model.words)
+        expected = keras_model.predict(bags)
+        result = numpy_model.predict(bags)
+
+        self.assertEqual(list(result.argmax(axis=1)),
+                         list(expected.argmax(axis=1)))
+        numpy.testing.assert_allclose(result, expected, atol=1e-5)
+
+
+class BagOfWordsTestCase(TestCase):
+    def test_encoding(self):
+        from chatbot.chat import fill_bag_of_words, return_bag_of_words, \
+            return_bags_of_words
+
+        words = ['calculus', 'hello', 'help', 'integral']
+        bag = fill_bag_of_words(numpy.zeros(len(words), dtype=int),
+                                ['hello', 'help', 'me', 'hello'], words)
+        self.assertEqual(list(bag), [0, 1, 1, 0])
+
+        sentences = ['hello', 'integral help']
+        bags = return_bags_of_words(sentences, words)
+        self.assertEqual(bags.shape, (2, len(words)))
+        for row, sentence in zip(bags, sentences):
+            self.assertEqual(list(row),
+                             list(return_bag_of_words(sentence, words)))
+
+
+class MicroBatcherTestCase(TestCase):
+    def test_concurrent_predictions_share_batches(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from chatbot.batching import MicroBatcher
+
+        batch_sizes = []
+
+        def predict(batch):
+            batch_sizes.append(len(batch))
+            return batch * 2
+
+        batcher = MicroBatcher(predict, window=0.05, max_size=8)
+        rows = [numpy.array([[i, i + 1]]) for i in range(20)]
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            results = list(executor.map(batcher.predict, rows))
+
+        for row, result in zip(rows, results):
+            self.assertEqual(result.tolist(), (row * 2).tolist())
+        self.assertEqual(sum(batch_sizes), 20)
+        self.assertLessEqual(max(batch_sizes), 8)
+        self.assertLess(len(batch_sizes), 20)
+
+        stats = batcher.stats()
+        self.assertEqual(stats['items'], 20)
+        self.assertEqual(stats['fill_ratio'], 20 / (len(batch_sizes) * 8))
+
+    def test_errors_reach_callers(self):
+        from chatbot.batching import MicroBatcher
+
+        def predict(batch):
+            raise ValueError('bad batch')
+
+        with self.assertRaises(ValueError):
+            MicroBatcher(predict).predict(numpy.zeros((1, 2)))
+
+
+class ChatbotCacheTestCase(TestCase):
+    def test_memoized_intents(self):
+        from chatbot import chat
+
+        first = chat.predict_intents('hello  there', chat.model)
+        hits = chat._predict_intents.cache_info().hits
+        first[0]['intent'] = 'changed'
+
+        second = chat.predict_intents(' hello there ', chat.model)
+        self.assertEqual(chat._predict_intents.cache_info().hits, hits + 1)
+        self.assertEqual(second,
+                         chat.prediction_filter('hello there', chat.model))
+
+    def test_response_from_tag(self):
+        from chatbot import chat
+
+        for intent in chat.intents['intents']:
+            response = chat.get_response([{'intent': intent['tag']}],
+                                         chat.intents)
+            self.assertIn(response, intent['responses'])
+
+
+class RegexTokenizerTestCase(TestCase):
+    def test_treebank_rules(self):
+        from chatbot.tokenizers import regex_tokenize
+
+        self.assertEqual(
+            regex_tokenize("Hi. I can't use L'hopital's rule, it's hard..."),
+            ['Hi', '.', 'I', 'ca', "n't", 'use', "L'hopital", "'s", 'rule',
+             ',', 'it', "'s", 'hard', '...'])
+        self.assertEqual(
+            regex_tokenize('what is "u" for 1,000 (or -1)?'),
+            ['what', 'is', '``', 'u', "''", 'for', '1,000', '(', 'or', '-1',
+             ')', '?'])
+
+    @unittest.skipUnless(punkt_available(), 'needs the NLTK punkt data')
+    def test_matches_nltk_on_intents(self):
+        import nltk
+        from chatbot.tokenizers import regex_tokenize
+
+        with open('chatbot/data/intents.json') as f:
+            intents = json.load(f)
+        for intent in intents['intents']:
+            for pattern in intent['patterns']:
+                self.assertEqual(regex_tokenize(pattern),
+                                 nltk.word_tokenize(pattern))
+
+
+class ReadinessTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.math_warm = views.math_warm
+
+    def tearDown(self):
+        views.math_warm = self.math_warm
+        super().tearDown()
+
+    def test_healthz(self):
+        response = self.client.get('/healthz')
+        self.assertEqual(response.status_code, 200)
+
+    def test_ready_once_math_is_warm(self):
+        views.math_warm = False
+        response = self.client.get('/readyz')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['math_engine'], 'cold')
+
+        views.warm_up_math()
+        response = self.client.get('/readyz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['math_engine'], 'warm')
+
+    def test_waits_for_background_chatbot(self):
+        views.warm_up_math()
+        with mock.patch.object(views.settings, 'CHATBOT_LOAD', 'background'), \
+                mock.patch.object(views, 'chat', None):
+            response = self.client.get('/readyz')
+            self.assertEqual(response.status_code, 503)
+
+            views.load_chatbot_in_background().join()
+            response = self.client.get('/readyz')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['chatbot'], 'loaded')
+
+    def test_gunicorn_workers_load_the_chatbot_lazily(self):
+        from mathtutor import gunicorn_conf
+
+        worker = mock.Mock()
+        worker.cfg.preload_app = False
+        with mock.patch.object(views.settings, 'CHATBOT_LOAD', 'lazy'), \
+                mock.patch.object(views, 'load_chatbot') as load_chatbot:
+            gunicorn_conf.post_worker_init(worker)
+            gunicorn_conf.warm_up()
+        load_chatbot.assert_not_called()
+        self.assertTrue(views.math_warm)
+
+    def test_gunicorn_warms_up_once(self):
+        with mock.patch.dict(os.environ), \
+                mock.patch.object(views, 'warm_up') as warm_up:
+            from mathtutor import gunicorn_conf
+            importlib.reload(gunicorn_conf)
+            sys.modules.pop('mathtutor.wsgi', None)
+            importlib.import_module('mathtutor.wsgi')
+            warm_up.assert_not_called()
+
+            worker = mock.Mock()
+            worker.cfg.preload_app = False
+            gunicorn_conf.post_worker_init(worker)
+            warm_up.assert_called_once_with()
+
+
+class DiffStepsMemoTestCase(TestCase):
+    def test_shared_subtrees_are_reused(self):
+        x = sympy.Symbol('x')
+        diffsteps.step_cache.clear()
+        first = diffsteps.diff_steps(sympy.cos(x)**7 * sympy.tan(x), x)
+        hits = diffsteps.step_cache.stats()['hits']
+        second = diffsteps.diff_steps(sympy.cos(x)**7 + sympy.sin(x), x)
+
+        self.assertGreater(diffsteps.step_cache.stats()['hits'], hits)
+        cos_steps = [step for step in first.substeps + second.substeps
+                     if step.context == sympy.cos(x)**7]
+        self.assertEqual(len(cos_steps), 2)
+        self.assertIs(cos_steps[0], cos_steps[1])
+
+    def test_chain_rules_are_reused(self):
+        x = sympy.Symbol('x')
+        diffsteps.step_cache.clear()
+        first = diffsteps.diff_steps(sympy.exp(sympy.sin(2 * x)), x)
+        diffsteps.diff(first)
+        diffsteps.step_cache.clear()
+        hits = diffsteps.derivative_cache.stats()['hits']
+        second = diffsteps.diff_steps(sympy.exp(sympy.sin(2 * x)), x)
+
+        self.assertEqual(first, second)
+        self.assertEqual(diffsteps.diff(second),
+                         sympy.exp(sympy.sin(2 * x)) * 2 * sympy.cos(2 * x))
+        self.assertEqual(diffsteps.derivative_cache.stats()['hits'], hits + 1)
+
+    def test_rewrites_keep_their_own_derivatives(self):
+        x = sympy.Symbol('x')
+        rule = diffsteps.diff_steps(sympy.cot(x), x)
+        _, by_tan, by_sin_cos = rule.alternatives
+
+        self.assertEqual(diffsteps.diff(by_tan),
+                         diffsteps.diff(by_tan.substep))
+        self.assertEqual(diffsteps.diff(by_sin_cos),
+                         diffsteps.diff(by_sin_cos.substep))
+        self.assertNotEqual(diffsteps.diff(by_tan),
+                            diffsteps.diff(by_sin_cos))
+
+
+class LatexCacheTestCase(TestCase):
+    def test_repeated_expressions_hit_the_cache(self):
+        x = sympy.Symbol('x')
+        expr = sympy.sin(x)**2 / sympy.sqrt(x + 17)
+        latexcache.latex_cache.clear()
+        first = latexcache.latex(expr, 'test')
+        hits = latexcache.latex_stats()['sites']['test']['hits']
+        second = latexcache.latex(sympy.sin(x)**2 / sympy.sqrt(x + 17), 'test')
+
+        self.assertEqual(first, sympy.latex(expr))
+        self.assertIs(first, second)
+        self.assertEqual(
+            latexcache.latex_stats()['sites']['test']['hits'], hits + 1)
+
+    def test_keys_include_type_and_settings(self):
+        x = sympy.Symbol('x')
+        self.assertEqual(latexcache.latex(1), '1')
+        self.assertEqual(latexcache.latex(True), sympy.latex(True))
+        self.assertEqual(latexcache.latex(x**2, mode='inline'), '$x^{2}$')
+        self.assertEqual(latexcache.latex(x**2), 'x^{2}')
+        self.assertEqual(latexcache.latex([x, 1]), sympy.latex([x, 1]))
+
+    def test_containers_bypass_the_cache(self):
+        self.assertEqual(latexcache.latex((1, 2)), sympy.latex((1, 2)))
+        self.assertEqual(latexcache.latex((1, 2.0)), sympy.latex((1, 2.0)))
+        self.assertEqual(latexcache.latex((1,)), sympy.latex((1,)))
+        self.assertEqual(latexcache.latex((True,)), sympy.latex((True,)))
+
+
+class RuleNodeTestCase(TestCase):
+    def test_namedtuple_interface(self):
+        x = sympy.Symbol('x')
+        rule = diffsteps.PowerRule(x, 2, x**2, x)
+        base, exp, context, symbol = rule
+
+        self.assertEqual((base, exp, context, symbol), (x, 2, x**2, x))
+        self.assertEqual(rule[1], 2)
+        self.assertEqual(rule._fields, ('base', 'exp', 'context', 'symbol'))
+        self.assertEqual(rule._replace(exp=3).exp, 3)
+        self.assertEqual(rule, diffsteps.PowerRule(**rule._asdict()))
+        self.assertEqual(hash(rule), hash(diffsteps.PowerRule(*rule)))
+        self.assertEqual(pickle.loads(pickle.dumps(rule)), rule)
+        with self.assertRaises(AttributeError):
+            rule.exp = 3
+
+    def test_renamed_only_within_block(self):
+        from logic.stepprinter import LaTeXPrinter
+
+        printer = LaTeXPrinter()
+        v = sympy.Dummy('v')
+        u = sympy.Symbol('u')
+        with printer.renamed(v, u):
+            self.assertEqual(printer.format_math(v**2), 'u^{2}')
+        self.assertEqual(printer.format_math(v**2), sympy.latex(v**2))
+
+        with self.assertRaises(ValueError):
+            with printer.renamed(v, u):
+                raise ValueError
+        self.assertEqual(printer.renames, [])
+
+
+class ThreadSafetyTestCase(TestCase):
+    INTEGRANDS = ['x*sin(x)', 'exp(2*x)/(1 + exp(x))', '1/(x**2 - x - 2)',
+                  '(2 + 3/x)**2', 'sin(x)*cos(x)', 'sec(x)**2*tan(x)',
+                  'cot(x)', 'x*exp(x)', 'x**2*exp(x)', 'cos(x)**3']
+
+    def test_concurrent_integral_steps_match_serial(self):
+        x = sympy.Symbol('x')
+        integrands = [sympy.sympify(i) for i in self.INTEGRANDS] * 3
+        serial = [intsteps.print_html_steps(i, x) for i in integrands]
+
+        with ThreadPoolExecutor(8) as pool:
+            threaded = list(pool.map(
+                lambda i: intsteps.print_html_steps(i, x), integrands))
+
+        self.assertEqual(threaded, serial)
+
+    def test_concurrent_cards_match_serial(self):
+        def evaluate(integrand):
+            return UserInput().evaluate_card(
+                'integral_alternate_fake', 'integrate({}, x)'.format(integrand),
+                'x', {})['output']
+
+        serial = [evaluate(i) for i in self.INTEGRANDS]
+        with ThreadPoolExecutor(8) as pool:
+            threaded = list(pool.map(evaluate, self.INTEGRANDS * 3))
+
+        self.assertEqual(threaded, serial * 3)
+
+    def test_integrals_in_progress_are_per_thread(self):
+        # Another thread working on x**2 (marked in progress, see
+        # intsteps.ContextDict) isn't taken for a cycle in this one
+        x = sympy.Symbol('x')
+        cache = importlib.import_module(
+            'sympy.integrals.manualintegrate')._integral_cache
+
+        def mark_and_integrate():
+            cache[(x**2, x)] = None
+            try:
+                return intsteps.integral_steps(x**2, x)
+            finally:
+                del cache[(x**2, x)]
+
+        with ThreadPoolExecutor(1) as pool:
+            self.assertIsNone(pool.submit(mark_and_integrate).result())
+        self.assertIsInstance(intsteps.integral_steps(x**2, x),
+                              intsteps.PowerRule)
+
+    def test_printed_output_stays_with_its_evaluation(self):
+        def evaluate(n):
+            return Eval(Namespace()).eval(
+                'for i in range(50):\n    print({0})\n{0}'.format(n))
+
+        with ThreadPoolExecutor(8) as pool:
+            outputs = list(pool.map(evaluate, range(40)))
+
+        for n, output in enumerate(outputs):
+            self.assertEqual(output, '{}\n'.format(n) * 50 + str(n))
+
+
+class StepBudgetTestCase(TestCase):
+    def test_out_of_time_subintegrals_are_marked(self):
+        x = sympy.Symbol('x')
+        # Time for the search to start, then none for the subintegrals
+        remaining = itertools.chain([5], itertools.repeat(-1))
+        with mock.patch.object(intsteps, 'remaining_time',
+                               side_effect=remaining):
+            html = intsteps.print_html_steps(x**2 + sympy.sin(x), x)
+
+        self.assertIsInstance(html, stepstore.Partial)
+        self.assertIn('Integrate term-by-term', html)
+        self.assertEqual(html.count('Could not finish this sub-integral'), 2)
+
+    @mock.patch.object(stepstore, 'step_store', None)
+    def test_budget_parameter(self):
+        result = UserInput().evaluate_card(
+            'intsteps', 'integrate(x*sin(x), x)', 'x', {'budget': '1e-9'})
+        self.assertIn('Could not finish this sub-integral', result['output'])
+
+        result = UserInput().evaluate_card(
+            'intsteps', 'integrate(x*sin(x), x)', 'x', {})
+        self.assertNotIn('Could not finish', result['output'])
+
+    def test_parse_budget(self):
+        with mock.patch.multiple(intsteps, default_budget=10, max_budget=30):
+            self.assertEqual(intsteps.parse_budget(''), 10)
+            self.assertEqual(intsteps.parse_budget('2.5'), 2.5)
+            self.assertEqual(intsteps.parse_budget('600'), 30)
+            with self.assertRaises(ValueError):
+                intsteps.parse_budget('soon')
+            with self.assertRaises(ValueError):
+                intsteps.parse_budget('-1')
+
+    def test_steps_with_an_unsimplified_answer_are_partial(self):
+        x = sympy.Symbol('x')
+        slow = mock.patch.object(intsteps, 'simplify_answer',
+                                 lambda answer: time.sleep(5))
+        with slow, mock.patch.object(intsteps, 'SIMPLIFY_TIME_LIMIT', 0.1):
+            html = intsteps.print_html_steps(x * sympy.exp(x), x)
+            self.assertIsInstance(html, stepstore.Partial)
+            stepstore.cached_steps('intsteps', intsteps.STEPS_VERSION,
+                                   x * sympy.exp(x), x,
+                                   intsteps.print_html_steps)
+
+        html = stepstore.cached_steps('intsteps', intsteps.STEPS_VERSION,
+                                      x * sympy.exp(x), x,
+                                      intsteps.print_html_steps)
+        self.assertIn(r'\left(x - 1\right) e^{x}', html)
+
+    def test_budget_is_kept_off_the_main_thread(self):
+        # SIGALRM can't interrupt other threads, so the call is made in a
+        # worker process that is killed
+        pool = WorkerPool(processes=1)
+        self.addCleanup(pool.close)
+
+        def sleep():
+            start = time.monotonic()
+            with self.assertRaises(intsteps.OutOfTime):
+                intsteps.call_in_time(0.5, time.sleep, 30)
+            return time.monotonic() - start
+
+        with mock.patch.object(intsteps, 'worker_pool', pool), \
+                ThreadPoolExecutor(1) as threads:
+            self.assertLess(threads.submit(sleep).result(), 5)
+
+
+class SimplifyCheckTestCase(TestCase):
+    def test_likely_to_shrink(self):
+        x = sympy.Symbol('x')
+        self.assertFalse(likely_to_shrink(-x * sympy.cos(x) + sympy.sin(x)))
+        self.assertFalse(likely_to_shrink(
+            x**3 - 3 * x * sympy.cos(x) + 6 * sympy.sin(x)))
+        # A common factor, also in short answers
+        self.assertTrue(likely_to_shrink(
+            x**2 * sympy.exp(x) - 2 * x * sympy.exp(x) + 2 * sympy.exp(x)))
+        self.assertTrue(likely_to_shrink(x * sympy.exp(x) - sympy.exp(x)))
+        self.assertTrue(likely_to_shrink(x * sympy.log(x) - x))
+        self.assertFalse(likely_to_shrink(x**3 / 3))
+        # Terms that are multiples of each other, or add up to a constant
+        self.assertTrue(likely_to_shrink(
+            sympy.sin(2 * x) + sympy.sin(x) * sympy.cos(x) + x**3))
+        self.assertTrue(likely_to_shrink(
+            sympy.sin(x)**2 + sympy.cos(x)**2 + x**5))
+
+    def test_simplest_answers_skip_simplify(self):
+        x = sympy.Symbol('x')
+        with mock.patch('sympy.simplify', wraps=sympy.simplify) as simplify:
+            intsteps.print_html_steps(x * sympy.sin(x), x)
+            simplify.assert_not_called()
+            intsteps.print_html_steps(x**2 * sympy.exp(x), x)
+            simplify.assert_called()
+
+
+class NumericIntegralTestCase(TestCase):
+    def test_quadrature(self):
+        x, y = sympy.symbols('x y')
+        value, error = numeric.quadrature(1 / sympy.sqrt(x**2 + 1),
+                                          [(x, 0, 1)])
+        self.assertAlmostEqual(value, float(sympy.asinh(1)), places=12)
+        self.assertLess(error, 1e-10)
+
+        value, _ = numeric.quadrature(sympy.exp(-x**2),
+                                      [(x, -sympy.oo, sympy.oo)])
+        self.assertAlmostEqual(value, float(sympy.sqrt(sympy.pi)), places=7)
+
+        # The bounds of the inner integral depend on the outer variable
+        value, _ = numeric.quadrature(x * y, [(x, 0, y), (y, 0, 1)])
+        self.assertAlmostEqual(value, 1 / 8, places=12)
+
+    def test_integrals_without_a_value(self):
+        x, y = sympy.symbols('x y')
+        for limits in ([x], [(x, 0, y)], [(x, 0, 1), (y, 0, x)]):
+            with self.assertRaises(ValueError):
+                numeric.quadrature(x * y, limits)
+        with self.assertRaises(ValueError):
+            numeric.quadrature(sympy.sqrt(x), [(x, -1, 1)])
+
+    def test_divergent_integrals(self):
+        x = sympy.Symbol('x')
+        for integrand, lower, upper in [
+                (1 / x, 0, 1), (1 / x, -1, 1), (sympy.tan(x), 0, 2),
+                (x**2, 1, sympy.oo), (1 / (x**2 - x - 2), 0, 3)]:
+            with self.subTest(integrand=integrand, bounds=(lower, upper)):
+                with self.assertRaises(ValueError):
+                    numeric.quadrature(integrand, [(x, lower, upper)])
+
+        # Singular, but integrable
+        value, _ = numeric.quadrature(1 / sympy.sqrt(x), [(x, 0, 1)])
+        self.assertAlmostEqual(value, 2, places=10)
+
+        response = self.client.get('/card/integral_numeric', {
+            'expression': 'integrate(1/x, (x, 0, 1))', 'variable': 'x'})
+        self.assertEqual(response.json(),
+                         {'error': 'The integral has no finite numeric value'})
+
+    def test_card_comes_first_for_definite_integrals(self):
+        cards = [card.get('card') for card in
+                 UserInput().change_to_cards('integrate(1/sqrt(x^2+1), (x, 0, 1))')]
+        self.assertEqual(cards[1:], ['integral_numeric',
+                                     'integral_alternate_fake', 'intsteps'])
+        for expression in ('integrate(x^2, x)', 'integrate(x*y, (x, 0, 1))',
+                           'integrate(x*y, (x, 0, 1), (y, 0, x))'):
+            cards = UserInput().change_to_cards(expression)
+            self.assertNotIn('integral_numeric',
+                             [card.get('card') for card in cards])
+
+    def test_top_level_integral_is_not_evaluated(self):
+        _, _, _, evaluated = UserInput().evaluate_user_input(
+            'integrate(x**2, (x, 0, 1))')
+        x = sympy.Symbol('x')
+        self.assertEqual(evaluated, sympy.Integral(x**2, (x, 0, 1)))
+
+
+class DefiniteIntegralsTestCase(TestCase):
+    def test_antiderivative_is_evaluated_at_all_bounds(self):
+        x = sympy.Symbol('x')
+        bounds = [(0, 1), (1, 2), (-3, 0.5), (2, 2)]
+        results = numeric.definite_integrals(x * sympy.sin(x), x, bounds)
+        for (a, b), result in zip(bounds, results):
+            self.assertEqual(result['method'], 'antiderivative')
+            expected = float(sympy.integrate(x * sympy.sin(x), (x, a, b)))
+            self.assertAlmostEqual(result['value'], expected, places=12)
+
+    def test_singular_points(self):
+        x = sympy.Symbol('x')
+        results = numeric.definite_integrals(
+            1 / (x**2 - x - 2), x, [(3, 4), (0, 1), (1, 3), (0, 3)])
+        self.assertEqual([result.get('method') for result in results],
+                         ['antiderivative', 'antiderivative', None, None])
+        self.assertAlmostEqual(results[1]['value'],
+                               -numpy.log(4) / 3, places=10)
+        self.assertIn('error', results[2])
+        self.assertIn('error', results[3])
+
+        results = numeric.definite_integrals(
+            1 / x, x, [(0, 1), (-1, 1), (-2, -1)])
+        self.assertIn('error', results[0])
+        self.assertIn('error', results[1])
+        self.assertAlmostEqual(results[2]['value'], -numpy.log(2),
+                               places=12)
+
+        results = numeric.definite_integrals(sympy.tan(x), x, [(1, 2)])
+        self.assertIn('error', results[0])
+
+        results = numeric.definite_integrals(
+            1 / sympy.sqrt(x), x, [(0, 1)])
+        self.assertEqual(results[0], {'value': 2.0,
+                                      'method': 'antiderivative'})
+
+    def test_infinite_bounds(self):
+        x = sympy.Symbol('x')
+        results = numeric.definite_integrals(
+            sympy.exp(-x), x, [(0, sympy.oo), (sympy.oo, 1)])
+        self.assertEqual(results[0], {'value': 1.0,
+                                      'method': 'antiderivative'})
+        self.assertAlmostEqual(results[1]['value'], -numpy.exp(-1),
+                               places=12)
+
+        results = numeric.definite_integrals(x**2, x, [(1, sympy.oo)])
+        self.assertIn('error', results[0])
+
+        results = numeric.definite_integrals(
+            sympy.exp(-x**2), x, [(-sympy.oo, sympy.oo)])
+        self.assertAlmostEqual(results[0]['value'], numpy.sqrt(numpy.pi),
+                               places=7)
+
+    def test_oscillatory(self):
+        x = sympy.Symbol('x')
+        results = numeric.definite_integrals(
+            sympy.sin(x) / x, x, [(1, sympy.oo), (0, sympy.oo)])
+        self.assertEqual(results[0]['method'], 'antiderivative')
+        self.assertAlmostEqual(results[0]['value'], 0.6247132564277136,
+                               places=12)
+        self.assertAlmostEqual(results[1]['value'], numpy.pi / 2,
+                               places=12)
+
+        results = numeric.definite_integrals(
+            sympy.sin(x), x, [(0, sympy.oo)])
+        self.assertIn('error', results[0])
+
+    def test_api(self):
+        response = self.client.post('/definite_integrals/', data=json.dumps({
+            'integrand': 'x^2',
+            'variable': 'x',
+            'bounds': [[0, 1], ['0', 'pi'], [1, 'oo']],
+        }), content_type='application/json')
+        results = response.json()['results']
+        self.assertAlmostEqual(results[0]['value'], 1 / 3, places=12)
+        self.assertAlmostEqual(results[1]['value'], numpy.pi**3 / 3,
+                               places=10)
+        self.assertIn('error', results[2])
+
+        response = self.client.post('/definite_integrals/', data=json.dumps({
+            'integrand': 'x*y', 'variable': 'x', 'bounds': [[0, 1]],
+        }), content_type='application/json')
+        self.assertIn('error', response.json())
+
+        response = self.client.post('/definite_integrals/', data='{}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+class ServerTimingTestCase(TestCase):
+    def test_stages_add_up(self):
+        with timing.stage('outside'):
+            pass
+        with timing.collect() as timings:
+            for _ in range(3):
+                with timing.stage('latex'):
+                    pass
+            with timing.stage('render'):
+                pass
+        self.assertEqual(list(timings.stages), ['latex', 'render'])
+        self.assertEqual(timings.stages['latex'][1], 3)
+        self.assertRegex(timings.header(),
+                         r'^latex;dur=[0-9.]+;desc="3 calls", '
+                         r'render;dur=[0-9.]+$')
+
+    def test_header(self):
+        card_cache.clear()
+        with self.settings(SERVER_TIMING=True):
+            response = self.client.get('/input/', {'i': 'diff(x^3, x)'})
+        names = [metric.split(';')[0] for metric in
+                 response['Server-Timing'].split(', ')]
+        for name in ('stringify', 'evaluate', 'result_set', 'card.diffsteps',
+                     'render', 'total'):
+            self.assertIn(name, names)
+
+    def test_log(self):
+        with self.settings(SERVER_TIMING=False, SERVER_TIMING_LOG=True):
+            with self.assertLogs('app.middleware', 'INFO') as logs:
+                response = self.client.get('/healthz')
+        self.assertNotIn('Server-Timing', response)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['path'], '/healthz')
+        self.assertIn('total', line['ms'])
+
+
+class StepsRegressionTestCase(TestCase):
+    """
+    The step printers produce the HTML recorded in app/testdata/steps.json
+    (see app/testdata/generate_steps.py) byte for byte.
+    """
+    def test_steps_unchanged(self):
+        from logic import intsteps
+
+        printers = {
+            'diffsteps': diffsteps.print_html_steps,
+            'intsteps': intsteps.print_html_steps,
+        }
+        with open(os.path.join(os.path.dirname(__file__), 'testdata',
+                               'steps.json')) as f:
+            cases = json.load(f)
+
+        for case in cases:
+            expr = sympy.sympify(case['expr'])
+            symbol = sympy.sympify(case['symbol'])
+            with self.subTest(kind=case['kind'], expr=str(expr)):
+                try:
+                    result = {'html': printers[case['kind']](expr, symbol)}
+                except Exception as e:
+                    result = {'error': '{}: {}'.format(type(e).__name__, e)}
+                expected = {key: case[key] for key in ('html', 'error')
+                            if key in case}
+                self.assertEqual(result, expected)
@@ -8,6 +8,11 @@ urlpatterns = [
     path('input/', views.input),
     path('reference/', views.reference_guide),
     path('card/<card_name>', views.return_result_as_card),
+    path('card/<card_name>/stream', views.stream_result_as_card),
+    path('cards/', views.return_results_as_cards),
+    path('definite_integrals/', views.definite_integrals),
+    path('healthz', views.healthz),
+    path('readyz', views.readyz),
 ]
 handler404 = 'app.views.handler404'
 handler500 = 'app.views.handler500'
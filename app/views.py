@@ -1,12 +1,15 @@
-from django.http import HttpResponse, JsonResponse, Http404
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, \
+    Http404, StreamingHttpResponse
 from django.shortcuts import render
 from django import forms
 from django.views.generic.base import TemplateView
 from django.views.generic import View
-from chatbot.chat import chatbot_response
 from logic.logic import UserInput
+from logic.pool import WorkerPool
+from logic import timing
 from mathtutor import settings
 import json
+import threading
 import urllib
 import urllib.parse
 import traceback
@@ -37,6 +40,68 @@ HOME_PAGE_EXAMPLES = [
     ]),
 ]
 
+card_pool = None
+if settings.CARD_WORKER_PROCESSES:
+    card_pool = WorkerPool(processes=settings.CARD_WORKER_PROCESSES,
+                           timeout=settings.CARD_WORKER_TIMEOUT,
+                           cpu_limit=settings.CARD_WORKER_CPU_LIMIT,
+                           memory_limit=settings.CARD_WORKER_MEMORY_LIMIT)
+
+# chatbot.chat loads the chatbot model when imported, so it's only imported
+# by load_chatbot, on the first chatbot request or in a background thread
+chat = None
+chatbot_error = None
+chatbot_loading = False
+_chatbot_lock = threading.Lock()
+
+math_warm = False
+
+def load_chatbot():
+    """Import and configure the chatbot on first use."""
+    global chat, chatbot_error
+    with _chatbot_lock:
+        if chat is None:
+            try:
+                from chatbot import chat as module
+                module.set_tokenizer(settings.CHATBOT_TOKENIZER)
+                if settings.CHATBOT_BATCH_WINDOW:
+                    module.enable_batching(settings.CHATBOT_BATCH_WINDOW,
+                                           settings.CHATBOT_BATCH_SIZE)
+            except Exception as e:
+                chatbot_error = e
+                raise
+            chat, chatbot_error = module, None
+    return chat
+
+def load_chatbot_in_background():
+    global chatbot_loading
+    chatbot_loading = True
+
+    def load():
+        global chatbot_loading
+        try:
+            load_chatbot()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            chatbot_loading = False
+
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    return thread
+
+def warm_up_math():
+    """Evaluate an example so that the first request isn't the slow one."""
+    global math_warm
+    UserInput().evaluate_user_input('diff(x^2, x)')
+    math_warm = True
+
+def warm_up():
+    """Warm up the math engine, and start loading the chatbot if configured."""
+    if settings.CHATBOT_LOAD == 'background':
+        load_chatbot_in_background()
+    warm_up_math()
+
 class TextInputWidget(forms.widgets.TextInput):
     def render(self, name, value, attrs=None, renderer=None):
         if attrs is None:
@@ -62,19 +127,21 @@ def input(request):
         form = SearchForm(request.GET)
         if form.is_valid():
             input = form.cleaned_data["i"]
-            evaluated = UserInput().change_to_cards(input)
+            with timing.stage('cards'):
+                evaluated = UserInput(pool=card_pool).change_to_cards(input)
             if not evaluated:
                 evaluated = [{
                     "title": "Input",
                     "input": input,
                     "output": "Can't handle the input."
                 }]
-            return render(request, "result.html", {
-                "input": input,
-                "result": evaluated,
-                "form": form,
-                "MEDIA_URL": settings.STATIC_URL,
-            })
+            with timing.stage('render'):
+                return render(request, "result.html", {
+                    "input": input,
+                    "result": evaluated,
+                    "form": form,
+                    "MEDIA_URL": settings.STATIC_URL,
+                })
 
 
 def process_variables_and_expressions(request, card_name):
@@ -98,11 +165,11 @@ def return_result_as_card(request, card_name):
     unquoted_variable, unquoted_expression, parameters = process_variables_and_expressions(
         request, card_name)
     try:
-        result = UserInput().evaluate_card(
+        result = UserInput(pool=card_pool).evaluate_card(
             card_name, unquoted_expression, unquoted_variable, parameters)
     except ValueError as e:
         return HttpResponse(json.dumps({
-            'error': e
+            'error': str(e)
         }), content_type="application/json")
     except:
         trace = traceback.format_exc(5)
@@ -113,6 +180,107 @@ def return_result_as_card(request, card_name):
 
     return HttpResponse(json.dumps(result), content_type="application/json")
       
+def stream_result_as_card(request, card_name):
+    """
+    Stream the output of a step card as newline delimited JSON: an
+    {"output": ...} object per chunk of HTML, then {"done": true} or an
+    {"error": ...} object.
+    """
+    unquoted_variable, unquoted_expression, parameters = process_variables_and_expressions(
+        request, card_name)
+
+    def stream():
+        try:
+            for chunk in UserInput().stream_card(
+                    card_name, unquoted_expression, unquoted_variable,
+                    parameters):
+                yield json.dumps({'output': chunk}) + '\n'
+        except ValueError as e:
+            yield json.dumps({'error': str(e)}) + '\n'
+            return
+        except:
+            trace = traceback.format_exc(5)
+            yield json.dumps({
+                'error': ('There was an error. For reference'
+                          'the last five traceback entries are: ' + trace)
+            }) + '\n'
+            return
+        yield json.dumps({'done': True}) + '\n'
+
+    return StreamingHttpResponse(stream(),
+                                 content_type="application/x-ndjson")
+
+def return_results_as_cards(request):
+    """
+    Evaluate several cards of one result page in a single request.
+
+    Expects a JSON body with the expression, the variable and a list of
+    cards, each with a name and its parameters.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        unquoted_variable = urllib.parse.unquote(data['variable'])
+        unquoted_expression = urllib.parse.unquote(data['expression'])
+        cards = [(card['name'], card.get('parameters') or {})
+                 for card in data['cards']]
+    except (ValueError, KeyError, TypeError):
+        raise Http404
+
+    try:
+        results = UserInput(pool=card_pool).evaluate_cards(
+            cards, unquoted_expression, unquoted_variable)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)})
+    except:
+        trace = traceback.format_exc(5)
+        return JsonResponse({
+            'error': ('There was an error. For reference'
+                      'the last five traceback entries are: ' + trace)
+        })
+
+    return JsonResponse({'cards': results})
+
+def definite_integrals(request):
+    """
+    Integrate one integrand between many bounds.
+
+    Expects a JSON body with the integrand, the variable and a list of
+    bounds, each a [lower, upper] pair.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        integrand = data['integrand']
+        variable = data['variable']
+        bounds = [(lower, upper) for lower, upper in data['bounds']]
+    except (ValueError, KeyError, TypeError):
+        raise Http404
+
+    if len(bounds) > settings.DEFINITE_INTEGRALS_MAX_BOUNDS:
+        return JsonResponse({
+            'error': 'At most {} bounds may be given at once'.format(
+                settings.DEFINITE_INTEGRALS_MAX_BOUNDS)
+        })
+
+    try:
+        results = UserInput(pool=card_pool).definite_integrals(
+            integrand, variable, bounds)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)})
+    except:
+        trace = traceback.format_exc(5)
+        return JsonResponse({
+            'error': ('There was an error. For reference'
+                      'the last five traceback entries are: ' + trace)
+        })
+
+    return JsonResponse({'results': results})
+
 def reference_guide(request):
     return render(request, "reference.html", {
         "MEDIA_URL": settings.STATIC_URL,
@@ -128,7 +296,7 @@ class ChatBotApiView(View):
     def post(self, request, *args, **kwargs):
         input_data = json.loads(request.body.decode('utf-8'))
         msg = input_data['text']
-        response = chatbot_response(msg)
+        response = load_chatbot().chatbot_response(msg)
 
         return JsonResponse({
             'text': [
@@ -137,6 +305,34 @@ class ChatBotApiView(View):
         }, status=200)
 
 
+def healthz(request):
+    """Liveness: the process is up and serving requests."""
+    return JsonResponse({'status': 'ok'})
+
+
+def readyz(request):
+    """
+    Readiness: 200 once the math engine is warm and, if it's loaded in the
+    background, the chatbot model is loaded; 503 until then.
+    """
+    if chat is not None:
+        chatbot = 'loaded'
+    elif chatbot_error is not None:
+        chatbot = 'failed'
+    elif chatbot_loading:
+        chatbot = 'loading'
+    else:
+        chatbot = 'not loaded'
+
+    ready = math_warm and (chatbot == 'loaded' or
+                           settings.CHATBOT_LOAD != 'background')
+    return JsonResponse({
+        'ready': ready,
+        'math_engine': 'warm' if math_warm else 'cold',
+        'chatbot': chatbot,
+    }, status=200 if ready else 503)
+
+
 def handler404(request, exception):
     return render(request, "404.html")
 
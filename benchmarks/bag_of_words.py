@@ -0,0 +1,49 @@
+"""
+Compare the old bag of words encoder (a scan of the vocabulary for every
+token) with chatbot.chat.fill_bag_of_words as the vocabulary grows.
+Sentences are tokenized up front so only the encoding is timed.
+
+Run from the repository root with ``python -m benchmarks.bag_of_words``.
+"""
+import timeit
+
+import numpy as np
+
+from chatbot import chat
+
+
+def legacy_bag_of_words(sentence_words, words):
+    bag = [0]*len(words)
+    for s in sentence_words:
+        for i, w in enumerate(words):
+            if w == s:
+                bag[i] = 1
+    return np.array(bag)
+
+
+def indexed_bag_of_words(sentence_words, words):
+    return chat.fill_bag_of_words(np.zeros(len(words), dtype=int),
+                                  sentence_words, words)
+
+
+def main(number=20):
+    sentences = [chat.clean_up_sentence(pattern)
+                 for intent in chat.intents['intents']
+                 for pattern in intent['patterns']]
+
+    print('{:>10} {:>12} {:>12} {:>8}'.format(
+        'vocabulary', 'legacy (ms)', 'indexed (ms)', 'speedup'))
+    for scale in (1, 10, 100):
+        words = list(chat.words) + ['filler%d' % i for i in
+                                    range(len(chat.words) * (scale - 1))]
+        times = []
+        for encode in (legacy_bag_of_words, indexed_bag_of_words):
+            times.append(timeit.timeit(
+                lambda: [encode(s, words) for s in sentences],
+                number=number) / number * 1000)
+        print('{:>10} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            len(words), times[0], times[1], times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
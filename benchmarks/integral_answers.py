@@ -0,0 +1,61 @@
+"""
+Time the integral steps cards with and without the check of whether the
+answer is worth simplifying (logic.simplification.likely_to_shrink), and
+list the answers the check changes.
+
+Run from the repository root with ``python -m benchmarks.integral_answers``.
+"""
+import time
+from unittest import mock
+
+import sympy
+
+from logic import intsteps
+
+x = sympy.Symbol('x')
+
+INTEGRANDS = [
+    'cot(x)', 'exp(2*x)/(1 + exp(x))', '1/(x**2 - x - 2)', '(2 + 3/x)**2',
+    'sin(x)*cos(x)', 'sec(x)**2*tan(x)', 'x*sin(x)', 'x*sqrt(x**2 + 1)',
+    'x**2*exp(x)', 'cos(x)**3', 'sin(x)**2', 'x*log(x)', 'exp(x)*cos(x)',
+    'sin(x)**4', 'tan(x)**3*sec(x)', 'x**3*sin(x)', 'sin(x)**3*cos(x)',
+    'x*exp(x)', 'log(x)',
+]
+
+
+def best_time(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        # Clear SymPy's cache so each run does the same work
+        sympy.cache.clear_cache()
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    print('{:24} {:>10} {:>10}'.format('integrand', 'always', 'checked'))
+    totals = [0, 0]
+    changed = []
+    for integrand in INTEGRANDS:
+        expr = sympy.sympify(integrand)
+        steps = lambda: intsteps.print_html_steps(expr, x)
+        with mock.patch.object(intsteps, 'likely_to_shrink',
+                               lambda answer: True):
+            always, always_html = best_time(steps)
+        checked, checked_html = best_time(steps)
+        totals[0] += always
+        totals[1] += checked
+        if always_html != checked_html:
+            changed.append(integrand)
+        print('{:24} {:>8.1f}ms {:>8.1f}ms'.format(
+            integrand, always * 1000, checked * 1000))
+    print('{:24} {:>8.1f}ms {:>8.1f}ms'.format(
+        'total', totals[0] * 1000, totals[1] * 1000))
+    print('answers no longer simplified:', ', '.join(changed) or 'none')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Start gunicorn with mathtutor/gunicorn_conf.py with and without
+preload_app, and report the memory of each worker: RSS, PSS (shared pages
+split between the processes using them) and USS (pages only that worker
+uses). Linux only, as it reads /proc/<pid>/smaps_rollup.
+
+Run from the repository root with ``python -m benchmarks.memory_report``.
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+WORKERS = 3
+PORT = 8765
+
+
+def memory(pid):
+    """RSS, PSS and USS of a process in MiB."""
+    fields = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    uss = fields['Private_Clean'] + fields['Private_Dirty']
+    return fields['Rss'] / 1024, fields['Pss'] / 1024, uss / 1024
+
+
+def children(pid):
+    with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def wait_until_ready(process, timeout=300):
+    deadline = time.monotonic() + timeout
+    url = 'http://127.0.0.1:{}/readyz'.format(PORT)
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited')
+        try:
+            urllib.request.urlopen(url, timeout=5)
+        except OSError:
+            time.sleep(0.5)
+            continue
+        if len(children(process.pid)) == WORKERS:
+            return
+    raise RuntimeError('gunicorn did not get ready')
+
+
+def settled_memory(pids):
+    """Memory of each process once it stops growing (workers load on boot)."""
+    previous = None
+    while True:
+        current = [memory(pid) for pid in pids]
+        if previous and all(abs(a[0] - b[0]) < 1 for a, b in
+                            zip(current, previous)):
+            return current
+        previous = current
+        time.sleep(2)
+
+
+def report(preload):
+    env = dict(os.environ, GUNICORN_PRELOAD='1' if preload else '0')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'mathtutor/gunicorn_conf.py',
+         '-w', str(WORKERS), '-b', '127.0.0.1:{}'.format(PORT),
+         'mathtutor.wsgi'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(process)
+        workers = settled_memory(children(process.pid))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+
+    print('preload_app = {}'.format(preload))
+    print('{:>8} {:>10} {:>10} {:>10}'.format(
+        'worker', 'RSS (MiB)', 'PSS (MiB)', 'USS (MiB)'))
+    for i, (rss, pss, uss) in enumerate(workers):
+        print('{:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(i, rss, pss, uss))
+    print('{:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+        'total', *[sum(column) for column in zip(*workers)]))
+    print()
+
+
+def main():
+    report(preload=False)
+    report(preload=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Compare the old parse pipeline (stringify_expr, then parse_expr, then
+arguments()) with UserInput.evaluate_user_input on the home page examples.
+evaluate_user_input leaves calls in DEFERRED_CALLS (integrate) unevaluated,
+so the single pipeline evaluates them too, to time the same work.
+
+Run from the repository root with ``python -m benchmarks.parse_pipeline``.
+"""
+import os
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mathtutor.settings')
+
+import django
+django.setup()
+
+from sympy.parsing.sympy_parser import parse_expr
+
+from app.views import HOME_PAGE_EXAMPLES
+from logic.logic import UserInput
+from logic.utils import DEFERRED_CALLS, Eval, Namespace, arguments
+
+
+def examples():
+    for _, groups in HOME_PAGE_EXAMPLES:
+        for _, group in groups:
+            for example in group:
+                yield example[1] if isinstance(example, tuple) else example
+
+
+def legacy_pipeline(s):
+    namespace = Namespace()
+    evaluator = Eval(namespace)
+    parsed = UserInput().normalize_input(s, namespace)
+    evaluated = parse_expr(parsed, evaluate=True)
+    return parsed, arguments(parsed, evaluator), evaluator, evaluated
+
+
+def single_pipeline(s):
+    parsed, arguments, evaluator, evaluated = \
+        UserInput().evaluate_user_input(s)
+    if isinstance(evaluated, tuple(DEFERRED_CALLS.values())):
+        evaluated = evaluated.doit()
+    return parsed, arguments, evaluator, evaluated
+
+
+def main(number=5):
+    print('{:45} {:>12} {:>12} {:>8}'.format(
+        'input', 'legacy (ms)', 'single (ms)', 'speedup'))
+    totals = [0, 0]
+    for s in examples():
+        legacy = timeit.timeit(lambda: legacy_pipeline(s), number=number)
+        single = timeit.timeit(lambda: single_pipeline(s), number=number)
+        totals[0] += legacy
+        totals[1] += single
+        print('{:45} {:12.2f} {:12.2f} {:7.2f}x'.format(
+            s, legacy / number * 1000, single / number * 1000, legacy / single))
+    print('{:45} {:12.2f} {:12.2f} {:7.2f}x'.format(
+        'total', totals[0] / number * 1000, totals[1] / number * 1000,
+        totals[0] / totals[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Memory of the derivative rule trees on large polynomial and product
+inputs: the size of the rule nodes themselves (the expressions they refer
+to are shared with SymPy's cache), and the peak memory allocated while the
+steps are printed.
+
+Run from the repository root with ``python -m benchmarks.rule_memory``.
+"""
+import sys
+import tracemalloc
+
+import sympy
+
+from logic import diffsteps
+
+x = sympy.Symbol('x')
+
+INPUTS = [
+    ('polynomial, 80 terms', sum(k * x**k for k in range(1, 81))),
+    ('product, 12 factors', sympy.Mul(*[sympy.sin(x + k) for k in range(12)])),
+    ('chained powers, 40 terms',
+     sum(sympy.cos(x)**k * sympy.tan(x + k) for k in range(1, 41))),
+]
+
+
+def rule_size(rule, seen=None):
+    """Number of rule nodes and bytes they (and their lists) take."""
+    if seen is None:
+        seen = set()
+    if id(rule) in seen:
+        return 0, 0
+    seen.add(id(rule))
+    nodes, size = 1, sys.getsizeof(rule)
+    for value in rule:
+        if hasattr(value, '_fields'):
+            children = [value]
+        elif isinstance(value, list):
+            size += sys.getsizeof(value)
+            children = [item for item in value if hasattr(item, '_fields')]
+        else:
+            children = []
+        for child in children:
+            child_nodes, child_size = rule_size(child, seen)
+            nodes += child_nodes
+            size += child_size
+    return nodes, size
+
+
+def main():
+    print('{:26} {:>7} {:>12} {:>16}'.format(
+        'input', 'nodes', 'rules (KiB)', 'print peak (KiB)'))
+    for name, expr in INPUTS:
+        rule = diffsteps.diff_steps(expr, x)
+        nodes, size = rule_size(rule)
+
+        diffsteps.HTMLPrinter(rule)  # warm SymPy's caches
+        tracemalloc.start()
+        diffsteps.HTMLPrinter(rule)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('{:26} {:>7} {:>12.1f} {:>16.1f}'.format(
+            name, nodes, size / 1024, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Compare nltk.word_tokenize with chatbot.tokenizers.regex_tokenize on the
+intents.json patterns. nltk.word_tokenize needs the punkt data (see
+chatbot/nltk_packages.py) and is skipped without it.
+
+Run from the repository root with ``python -m benchmarks.tokenizers``.
+"""
+import json
+import timeit
+
+import nltk
+
+from chatbot.tokenizers import punkt_available, regex_tokenize
+
+nltk.data.path.append('./nltk_data/')
+
+
+def main(number=20):
+    with open('chatbot/data/intents.json') as f:
+        intents = json.load(f)
+    patterns = [pattern for intent in intents['intents']
+                for pattern in intent['patterns']]
+
+    tokenizers = [('regex', regex_tokenize)]
+    if punkt_available():
+        tokenizers.insert(0, ('nltk', nltk.word_tokenize))
+    else:
+        print('punkt data not found, only timing the regex tokenizer')
+
+    for name, tokenize in tokenizers:
+        seconds = timeit.timeit(
+            lambda: [tokenize(pattern) for pattern in patterns],
+            number=number) / number
+        print('{:6} {:8.1f} us per message'.format(
+            name, seconds / len(patterns) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher(object):
+    """
+    Runs the rows that concurrent requests pass to predict() through the
+    model together. The first waiting row opens a batch, which collects
+    rows for up to ``window`` seconds or until it holds ``max_size`` rows,
+    and is then passed to ``predict_batch`` in one call.
+
+    predict() takes and returns 2-D arrays like the model's own predict,
+    so the batcher can stand in for the model.
+    """
+    def __init__(self, predict_batch, window=0.005, max_size=32):
+        self.predict_batch = predict_batch
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._requests = None
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        with self._lock:
+            # The thread doesn't survive a fork, so a forked process
+            # starts its own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._requests = queue.Queue()
+                threading.Thread(target=self._run, args=(self._requests,),
+                                 daemon=True).start()
+
+    def submit(self, row):
+        """Queue one input row, returning a Future for its output row."""
+        self.start()
+        future = Future()
+        self._requests.put((row, future))
+        return future
+
+    def predict(self, batch):
+        futures = [self.submit(row) for row in batch]
+        return np.array([future.result() for future in futures])
+
+    def _collect(self, requests):
+        pending = [requests.get()]
+        deadline = time.monotonic() + self.window
+        while len(pending) < self.max_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return pending
+
+    def _run(self, requests):
+        while True:
+            pending = self._collect(requests)
+            with self._lock:
+                self.batches += 1
+                self.items += len(pending)
+            try:
+                results = self.predict_batch(
+                    np.array([row for row, _ in pending]))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(pending, results):
+                future.set_result(result)
+
+    def stats(self):
+        """
+        Number of batches and rows run so far, and the average fill ratio
+        of the batches (rows per batch over max_size).
+        """
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'fill_ratio': (self.items / (self.batches * self.max_size)
+                               if self.batches else 0.0),
+            }
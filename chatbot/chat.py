@@ -1,44 +1,117 @@
+import functools
 import pathlib
 import random
 import json
-from keras.models import load_model
+import logging
+import os
 import numpy as np
 import pickle
 import nltk
-from nltk.tokenize import word_tokenize
 from nltk.stem.wordnet import WordNetLemmatizer
+from chatbot.batching import MicroBatcher
+from chatbot.numpy_model import NumpyModel
+from chatbot.tokenizers import get_tokenizer
 
 nltk.data.path.append('./nltk_data/')
 
 DIR_NAME = str(pathlib.Path().resolve())
 
-model = load_model(DIR_NAME+'/chatbot/chatbot_model/chatbot_model.h5')
+logger = logging.getLogger(__name__)
+
+MODEL_DIR = DIR_NAME+'/chatbot/chatbot_model/'
+
+def load_chatbot_model():
+    """
+    Load the NumPy export of the model (see chatbot/export_model.py) if it
+    exists, otherwise the Keras model.
+    """
+    if os.path.exists(MODEL_DIR+'chatbot_model.npz'):
+        model = NumpyModel.load(MODEL_DIR+'chatbot_model.npz',
+                                MODEL_DIR+'chatbot_model.json')
+        return model, model.words, model.classes
+
+    from keras.models import load_model
+    model = load_model(MODEL_DIR+'chatbot_model.h5')
+    words = pickle.load(open(DIR_NAME+'/chatbot/words.pkl', 'rb'))
+    classes = pickle.load(open(DIR_NAME+'/chatbot/classes.pkl', 'rb'))
+    return model, words, classes
+
+model, words, classes = load_chatbot_model()
 intents = json.loads(open(DIR_NAME+'/chatbot/data/intents.json').read())
-words = pickle.load(open(DIR_NAME+'/chatbot/words.pkl', 'rb'))
-classes = pickle.load(open(DIR_NAME+'/chatbot/classes.pkl', 'rb'))
+# Set by enable_batching to share forward passes between concurrent requests
+batcher = None
 lemmatizer = WordNetLemmatizer()
 
+def wordnet_available():
+    try:
+        lemmatizer.lemmatize('words')
+    except LookupError:
+        return False
+    return True
+
+# Checked once, so that missing data is logged once rather than per word
+lemmatize_words = wordnet_available()
+if not lemmatize_words:
+    # The wordnet data isn't installed (see chatbot/nltk_packages.py)
+    logger.warning('wordnet data not found, words are not lemmatized')
+# Word tokenizer, see set_tokenizer
+word_tokenize = get_tokenizer('auto')
+
+def set_tokenizer(name):
+    """Tokenize with the backend called ``name``, see get_tokenizer."""
+    global word_tokenize
+    word_tokenize = get_tokenizer(name)
+    _predict_intents.cache_clear()
+
+@functools.lru_cache(maxsize=4096)
+def lemmatize(word):
+    if not lemmatize_words:
+        return word
+    return lemmatizer.lemmatize(word)
+
 def clean_up_sentence(sentence):
     sentence_words = word_tokenize(sentence)
-    sentence_words = [lemmatizer.lemmatize(
-        word.lower()) for word in sentence_words]
+    sentence_words = [lemmatize(word.lower()) for word in sentence_words]
     return sentence_words
 
+_word_index = (None, {})
+
+def get_word_index(words):
+    """Map each vocabulary word to its position, reusing the last index."""
+    global _word_index
+    indexed_words, index = _word_index
+    if indexed_words is not words:
+        index = {w: i for i, w in enumerate(words)}
+        _word_index = (words, index)
+    return index
+
+def fill_bag_of_words(bag, sentence_words, words, show_details=False):
+    index = get_word_index(words)
+    for s in sentence_words:
+        i = index.get(s)
+        if i is not None:
+            bag[i] = 1
+            if show_details:
+                print("found in bag: %s" % s)
+    return bag
+
 def return_bag_of_words(sentence, words, show_details=False):
     sentence_words = clean_up_sentence(sentence)
-    bag = [0]*len(words)
-    for s in sentence_words:
-        for i, w in enumerate(words):
-            if w == s:
-                bag[i] = 1
-                if show_details:
-                    print("found in bag: %s" % w)
-    return(np.array(bag))
+    bag = np.zeros(len(words), dtype=int)
+    return fill_bag_of_words(bag, sentence_words, words, show_details)
+
+def return_bags_of_words(sentences, words, show_details=False):
+    """Encode several sentences into one array with a row per sentence."""
+    bags = np.zeros((len(sentences), len(words)), dtype=int)
+    for bag, sentence in zip(bags, sentences):
+        fill_bag_of_words(bag, clean_up_sentence(sentence), words,
+                          show_details)
+    return bags
 
 def prediction_filter(sentence, model):
 
     bag_of_words = return_bag_of_words(sentence, words, show_details=False)
-    res = model.predict(np.array([bag_of_words]))[0]
+    res = model.predict(bag_of_words[np.newaxis])[0]
     ERROR_THRESHOLD = 0.25
     results = [[i, r] for i, r in enumerate(res) if r > ERROR_THRESHOLD]
 
@@ -49,18 +122,51 @@ def prediction_filter(sentence, model):
     return return_list
 
 
+@functools.lru_cache(maxsize=1024)
+def _predict_intents(sentence, model):
+    return tuple(prediction_filter(sentence, model))
+
+
+def predict_intents(sentence, model):
+    """
+    prediction_filter memoized on the sentence with its whitespace
+    collapsed. Returns new dicts, so callers may change them.
+    """
+    sentence = ' '.join(sentence.split())
+    return [dict(i) for i in _predict_intents(sentence, model)]
+
+
+_tag_responses = (None, {})
+
+def get_tag_responses(intents_json):
+    """Map each intent tag to its responses, reusing the last index."""
+    global _tag_responses
+    indexed_intents, index = _tag_responses
+    if indexed_intents is not intents_json:
+        index = {i['tag']: i['responses'] for i in intents_json['intents']}
+        _tag_responses = (intents_json, index)
+    return index
+
+get_tag_responses(intents)
+
+
 def get_response(ints, intents_json):
     tag = ints[0]['intent']
-    list_of_intents = intents_json['intents']
-    for i in list_of_intents:
-        if(i['tag'] == tag):
-            result = random.choice(i['responses'])
-            break
-    return result
+    return random.choice(get_tag_responses(intents_json)[tag])
+
+
+def enable_batching(window=0.005, max_size=32):
+    """
+    Batch the predictions of concurrent calls to chatbot_response, waiting
+    up to ``window`` seconds for up to ``max_size`` sentences.
+    """
+    global batcher
+    batcher = MicroBatcher(model.predict, window, max_size)
+    return batcher
 
 
 def chatbot_response(sentence):
-    ints = prediction_filter(sentence, model)
+    ints = predict_intents(sentence, batcher or model)
     res = get_response(ints, intents)
     return res
 
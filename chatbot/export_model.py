@@ -0,0 +1,55 @@
+"""
+Export the Keras chatbot model to the files used by chatbot.numpy_model:
+the dense layer weights in chatbot_model.npz, and the vocabulary, intent
+classes and activations in chatbot_model.json.
+
+Run from the repository root after retraining the model:
+
+    python chatbot/export_model.py
+"""
+import json
+import pickle
+
+import numpy as np
+
+MODEL_DIR = './chatbot/chatbot_model/'
+KERAS_MODEL = MODEL_DIR + 'chatbot_model.h5'
+WEIGHTS = MODEL_DIR + 'chatbot_model.npz'
+INFO = MODEL_DIR + 'chatbot_model.json'
+
+
+def export_model(model_path=KERAS_MODEL, weights_path=WEIGHTS,
+                 info_path=INFO, words_path='./chatbot/words.pkl',
+                 classes_path='./chatbot/classes.pkl'):
+    from keras.models import load_model
+
+    model = load_model(model_path)
+    weights = {}
+    activations = []
+    for layer in model.layers:
+        config = layer.get_config()
+        if layer.__class__.__name__ == 'Dropout':
+            continue
+        if layer.__class__.__name__ != 'Dense':
+            raise ValueError('Cannot export layer ' + layer.name)
+        kernel, bias = layer.get_weights()
+        weights['kernel_%d' % len(activations)] = kernel
+        weights['bias_%d' % len(activations)] = bias
+        activations.append(config['activation'])
+
+    with open(words_path, 'rb') as f:
+        words = pickle.load(f)
+    with open(classes_path, 'rb') as f:
+        classes = pickle.load(f)
+
+    np.savez_compressed(weights_path, **weights)
+    with open(info_path, 'w') as f:
+        json.dump({
+            'activations': activations,
+            'words': words,
+            'classes': classes,
+        }, f, indent=1)
+
+
+if __name__ == "__main__":
+    export_model()
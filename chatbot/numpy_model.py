@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': relu,
+    'softmax': softmax,
+}
+
+
+class NumpyModel(object):
+    """
+    Forward pass of the exported chatbot model (a stack of dense layers)
+    in NumPy, so serving doesn't need Keras. Dropout only acts while
+    training, so it isn't part of the export.
+
+    layers -- List of (weights, bias, activation name) triples
+
+    words -- Vocabulary of the bag of words input
+
+    classes -- Intent tag of each output
+    """
+    def __init__(self, layers, words, classes):
+        self.layers = [(np.asarray(weights, dtype=np.float32),
+                        np.asarray(bias, dtype=np.float32),
+                        ACTIVATIONS[activation])
+                       for weights, bias, activation in layers]
+        self.words = words
+        self.classes = classes
+
+    @classmethod
+    def load(cls, weights_path, info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        with np.load(weights_path) as weights:
+            layers = [(weights['kernel_%d' % i], weights['bias_%d' % i],
+                       activation)
+                      for i, activation in enumerate(info['activations'])]
+        return cls(layers, info['words'], info['classes'])
+
+    def predict(self, batch):
+        x = np.asarray(batch, dtype=np.float32)
+        for weights, bias, activation in self.layers:
+            x = activation(x.dot(weights) + bias)
+        return x
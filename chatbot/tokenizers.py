@@ -0,0 +1,93 @@
+import re
+
+import nltk
+
+# Contractions the Treebank tokenizer splits from the word before them,
+# when they end the word; a bare ' is the possessive of a plural
+CONTRACTION = r"(?:n't|N'T|'(?:ll|LL|re|RE|ve|VE|[sSmMdD])?)"
+
+# Characters that are always tokens of their own
+SINGLE = r"""\]\[(){}<>;@#$%&?!\""""
+
+# Where a word ends: whitespace, a token of its own, a comma or colon not
+# followed by a digit (so 1,000 stays whole), an ellipsis, a dash, or the
+# period ending the sentence
+WORD_END = (r"""(?=[\s{single}]|[,:](?!\d)|\.\.\.|--|"""
+            r"""\.[\]\)}}>"']*\s*$|$)""".format(single=SINGLE))
+
+TOKEN = re.compile(r"""
+    (?P<quote>")
+  | \.\.\.
+  | --
+  | [{single}]
+  | [,:](?!\d)
+  | (?<=[^\s'])(?<!\.\.\.){contraction}{end}
+  | (?<!\.)\.(?=[\]\)}}>"']*\s*$)
+  | (?:[^\s{single},:]|[,:](?=\d))+?(?:(?={contraction}{end})|{end})
+""".format(single=SINGLE, contraction=CONTRACTION, end=WORD_END), re.X)
+
+# Words the Treebank tokenizer splits in two
+SPLIT_WORDS = re.compile(r"(?i)(can)(not)|(gim)(me)|(gon)(na)|(got)(ta)|"
+                         r"(lem)(me)|(wan)(na)")
+
+# A sentence ends after ? or !, or after a period that isn't part of an
+# ellipsis followed by a lowercase word, with any closing quotes or brackets
+SENTENCE_END = re.compile(r"""(?:[?!]|\.(?!\.))["')\]}]*\s+|"""
+                          r"""\.\.\.["')\]}]*\s+(?=[^\w\s]*[A-Z])""")
+
+
+def split_sentences(text):
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        yield text[start:match.end()]
+        start = match.end()
+    if start < len(text):
+        yield text[start:]
+
+
+def regex_tokenize(text):
+    """
+    Tokenize like nltk.word_tokenize (Punkt sentences, then Treebank
+    words) with one precompiled pattern and no NLTK data. Matches NLTK on
+    the training patterns and everyday chat messages; unlike Punkt, it
+    doesn't know abbreviations such as "Mr." so it may end a sentence
+    there.
+    """
+    tokens = []
+    for sentence in split_sentences(text):
+        for match in TOKEN.finditer(sentence):
+            token = match.group()
+            if match.group('quote'):
+                start = match.start()
+                opening = start == 0 or sentence[start - 1] in ' ([{<'
+                token = '``' if opening else "''"
+            split = SPLIT_WORDS.fullmatch(token)
+            if split:
+                tokens.extend(part for part in split.groups() if part)
+            else:
+                tokens.append(token)
+    return tokens
+
+
+def punkt_available():
+    try:
+        nltk.data.find('tokenizers/punkt',
+                       paths=nltk.data.path + ['./nltk_data/'])
+    except LookupError:
+        return False
+    return True
+
+
+def get_tokenizer(name='auto'):
+    """
+    Return the word tokenizer called ``name``: 'nltk' for
+    nltk.word_tokenize, 'regex' for regex_tokenize, or 'auto' for NLTK
+    when its punkt data is installed and the regex tokenizer otherwise.
+    """
+    if name == 'auto':
+        name = 'nltk' if punkt_available() else 'regex'
+    if name == 'nltk':
+        return nltk.word_tokenize
+    if name == 'regex':
+        return regex_tokenize
+    raise ValueError('Unknown tokenizer: ' + name)
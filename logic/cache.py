@@ -0,0 +1,91 @@
+import sys
+import threading
+import collections
+
+
+def approximate_size(obj):
+    """
+    Rough number of bytes held by a result, following the containers the
+    cards are built from (dicts, lists, tuples and strings).
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, val in obj.items():
+            size += approximate_size(key) + approximate_size(val)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += approximate_size(item)
+    return size
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache.
+
+    max_entries -- Maximum number of entries kept
+
+    max_bytes -- Maximum approximate size of all values, or None for no limit
+
+    sizeof -- Function used to measure a value
+    """
+    def __init__(self, max_entries=256, max_bytes=None,
+                 sizeof=approximate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while (len(self._entries) > self.max_entries or
+                   (self.max_bytes is not None and self.size > self.max_bytes)):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
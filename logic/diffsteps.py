@@ -3,15 +3,95 @@ import collections
 import functools
 
 from logic import stepprinter
-from logic.stepprinter import functionnames, replace_u_var
+from logic.cache import LRUCache
+from logic.stepprinter import functionnames
 
 from sympy.core.function import AppliedUndef
 from sympy.functions.elementary.trigonometric import TrigonometricFunction
 from sympy.strategies.core import switch
 
+# Bump when the printed steps change so stored HTML is invalidated
+STEPS_VERSION = '1'
+
+
+class RuleNode(object):
+    """
+    Base of the derivative rules. Rules are immutable slotted objects with
+    the interface of a namedtuple (iteration and indexing in field order,
+    _fields, _asdict and _replace), so that they can be unpacked into their
+    evaluators and handled like the integral rules. Unchanged expressions
+    and substeps are shared between rules rather than copied.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self._fields):
+            raise TypeError('{} takes {} arguments'.format(
+                self.__class__.__name__, len(self._fields)))
+        values = list(args)
+        for field in self._fields[len(args):]:
+            try:
+                values.append(kwargs.pop(field))
+            except KeyError:
+                raise TypeError('{} is missing {}'.format(
+                    self.__class__.__name__, field))
+        if kwargs:
+            raise TypeError('{} got unexpected {}'.format(
+                self.__class__.__name__, ', '.join(kwargs)))
+        for field, value in zip(self._fields, values):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("can't set attribute")
+
+    def __delattr__(self, name):
+        raise AttributeError("can't delete attribute")
+
+    def __iter__(self):
+        for field in self._fields:
+            yield getattr(self, field)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __eq__(self, other):
+        return (self.__class__ is other.__class__ and
+                tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__.__name__,) + tuple(self))
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(field, value)
+            for field, value in zip(self._fields, self)))
+
+    def __reduce__(self):
+        return (self.__class__, tuple(self))
+
+    def _asdict(self):
+        return collections.OrderedDict(zip(self._fields, self))
+
+    def _replace(self, **changes):
+        values = self._asdict()
+        values.update(changes)
+        return self.__class__(**values)
+
 
 def Rule(name, props=""):
-    return collections.namedtuple(name, props + " context symbol")
+    fields = tuple((props + " context symbol").split())
+    return type(name, (RuleNode,), {
+        '__slots__': fields,
+        '_fields': fields,
+        '__module__': __name__,
+    })
 
 ConstantRule = Rule("ConstantRule", "number")
 ConstantTimesRule = Rule("ConstantTimesRule", "constant other substep")
@@ -30,6 +110,17 @@ RewriteRule = Rule("RewriteRule", "rewritten substep")
 
 DerivativeInfo = collections.namedtuple('DerivativeInfo', 'expr symbol')
 
+# The variable of the outer function of every chain rule. A fresh Dummy per
+# rule would make equal rules unequal, and their derivatives never hit the
+# cache below; one is enough, as the outer function is a single rule in it
+# alone, substituted back before anything else sees it
+chain_var = sympy.Dummy('u')
+
+# Rules and derivatives of subexpressions, shared between requests; rules
+# are immutable, so a subexpression seen before reuses its whole subtree
+step_cache = LRUCache(max_entries=4096)
+derivative_cache = LRUCache(max_entries=4096)
+
 evaluators = {}
 
 
@@ -49,7 +140,7 @@ def power_rule(derivative):
         if isinstance(exp, sympy.Symbol):
             return ExpRule(expr, base, expr, symbol)
         else:
-            u = sympy.Dummy()
+            u = chain_var
             f = base ** u
             return ChainRule(
                 ExpRule(f, base, f, u),
@@ -61,7 +152,7 @@ def power_rule(derivative):
         if isinstance(base, sympy.Symbol):
             return PowerRule(base, exp, expr, symbol)
         else:
-            u = sympy.Dummy()
+            u = chain_var
             f = u ** exp
             return ChainRule(
                 PowerRule(u, exp, f, u),
@@ -108,7 +199,7 @@ def trig_rule(derivative):
 
     default = TrigRule(expr, expr, symbol)
     if not isinstance(arg, sympy.Symbol):
-        u = sympy.Dummy()
+        u = chain_var
         default = ChainRule(
             TrigRule(expr.func(u), expr.func(u), u),
             arg, u, diff_steps(arg, symbol),
@@ -155,7 +246,7 @@ def exp_rule(derivative):
     if isinstance(exp, sympy.Symbol):
         return ExpRule(expr, sympy.E, expr, symbol)
     else:
-        u = sympy.Dummy()
+        u = chain_var
         f = sympy.exp(u)
         return ChainRule(ExpRule(f, sympy.E, f, u),
                          exp, u, diff_steps(exp, symbol), expr, symbol)
@@ -171,7 +262,7 @@ def log_rule(derivative):
         if isinstance(arg, sympy.Symbol):
             return LogRule(arg, base, expr, symbol)
         else:
-            u = sympy.Dummy()
+            u = chain_var
             return ChainRule(LogRule(u, base, sympy.log(u, base), u),
                              arg, u, diff_steps(arg, symbol), expr, symbol)
 
@@ -266,6 +357,15 @@ def eval_alternative(alternatives, expr, symbol):
 
 
 def diff_steps(expr, symbol):
+    key = (expr, symbol)
+    rule = step_cache.get(key)
+    if rule is None:
+        rule = _diff_steps(expr, symbol)
+        step_cache.set(key, rule)
+    return rule
+
+
+def _diff_steps(expr, symbol):
     deriv = DerivativeInfo(expr, symbol)
 
     def key(deriv):
@@ -293,11 +393,24 @@ def diff_steps(expr, symbol):
     })(deriv)
 
 
+def derivative_key(rule):
+    # The derivative only depends on the expressions in the rule; substeps
+    # follow from them
+    return (rule.__class__.__name__,) + tuple(
+        field for field in rule
+        if isinstance(field, sympy.Basic) or type(field) is tuple)
+
+
 def diff(rule):
-    try:
-        return evaluators[rule.__class__](*rule)
-    except KeyError:
-        raise ValueError("Cannot evaluate derivative")
+    key = derivative_key(rule)
+    result = derivative_cache.get(key)
+    if result is None:
+        try:
+            result = evaluators[rule.__class__](*rule)
+        except KeyError:
+            raise ValueError("Cannot evaluate derivative")
+        derivative_cache.set(key, result)
+    return result
 
 
 class DiffPrinter(stepprinter.HTMLPrinter):
@@ -436,7 +549,8 @@ class DiffPrinter(stepprinter.HTMLPrinter):
         with self.new_step(), self.new_u_vars() as (u, _):
             self.append("Let {}.".format(
                 self.format_math(sympy.Eq(u, rule.inner))))
-            self.print_rule(replace_u_var(rule.substep, rule.u_var, u))
+            with self.renamed(self.rename(rule.u_var), u):
+                self.print_rule(rule.substep)
         with self.new_step():
             if isinstance(rule.innerstep, FunctionRule):
                 self.append(
@@ -530,9 +644,9 @@ class DiffPrinter(stepprinter.HTMLPrinter):
 
 
 class HTMLPrinter(DiffPrinter, stepprinter.HTMLPrinter):
-    def __init__(self, rule):
+    def __init__(self, rule, on_flush=None):
         self.alternative_functions_printed = set()
-        stepprinter.HTMLPrinter.__init__(self)
+        stepprinter.HTMLPrinter.__init__(self, on_flush)
         DiffPrinter.__init__(self, rule)
 
     def print_Alternative(self, rule):
@@ -563,9 +677,10 @@ class HTMLPrinter(DiffPrinter, stepprinter.HTMLPrinter):
                     self.append(self.format_math_display(simp) + '</ol></div>')
         self.lines.append('</ol>')
         self.level = 0
+        self.flush()
         return '\n'.join(self.lines)
 
 
-def print_html_steps(function, symbol):
-    a = HTMLPrinter(diff_steps(function, symbol))
+def print_html_steps(function, symbol, on_flush=None):
+    a = HTMLPrinter(diff_steps(function, symbol), on_flush)
     return a.finalize()
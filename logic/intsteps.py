@@ -1,28 +1,257 @@
+import collections.abc
+import contextlib
+import contextvars
+import functools
+import importlib
+import signal
+import threading
+import time
+
 import sympy
 from logic import stepprinter
-from logic.stepprinter import replace_u_var
+from logic.latexcache import latex
+from logic.pool import WorkerTimeout
+from logic.simplification import likely_to_shrink
+from logic.stepstore import Partial
 
-from sympy.integrals.manualintegrate import ( _manualintegrate, integral_steps, evaluates,
+from sympy.integrals.manualintegrate import ( _manualintegrate, evaluates,
     ConstantRule, ConstantTimesRule, PowerRule, AddRule, URule,
     PartsRule, CyclicPartsRule, TrigRule, ExpRule, LogRule, ArctanRule,
     AlternativeRule, DontKnowRule, RewriteRule
 )
 
-# Need this to break loops
+# Bump when the printed steps change so stored HTML is invalidated
+STEPS_VERSION = '2'
+
+# Seconds simplifying the answer may take before it is shown as found
+SIMPLIFY_TIME_LIMIT = 2
+
+# Seconds the steps of an integral may take when the card doesn't give a
+# budget, and the most it may ask for; None for no limit. Set from the
+# INTSTEPS_BUDGET and INTSTEPS_MAX_BUDGET settings.
+default_budget = None
+max_budget = None
+
+# The budget is a hard limit on the main thread, where time_limit can
+# interrupt SymPy with SIGALRM: sync gunicorn workers, and the card worker
+# processes (CARD_WORKER_PROCESSES). Other threads (gthread workers,
+# runserver, the thread streaming steps) can only stop between
+# subintegrals, so there sympy.integrate and simplify run in this
+# logic.pool.WorkerPool, which is killed when the budget runs out; without
+# it (INTSTEPS_WORKER_PROCESSES = 0) they aren't limited. See call_in_time.
+worker_pool = None
+
+# time.monotonic() by which the steps must be found, see time_budget
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class OutOfTime(BaseException):
+    """Raised by time_limit; not an Exception so SymPy doesn't catch it."""
+
+
+class TimeoutRule(DontKnowRule):
+    """An integral whose steps weren't found before the deadline."""
+    __slots__ = ()
+
+
+@contextlib.contextmanager
+def time_budget(seconds):
+    """
+    Give the integrals in this block ``seconds`` to finish, or no limit if
+    None. Nested budgets can't extend the deadline of the outer one.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    if _deadline.get() is not None:
+        deadline = min(deadline, _deadline.get())
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time():
+    """Seconds left in the current budget, or None if there is none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def parse_budget(budget):
+    """The budget parameter of a card in seconds, capped at max_budget."""
+    if not budget:
+        return default_budget
+    try:
+        budget = float(budget)
+    except (TypeError, ValueError):
+        raise ValueError('The budget must be a number of seconds')
+    if budget <= 0:
+        raise ValueError('The budget must be a number of seconds')
+    if max_budget is not None:
+        budget = min(budget, max_budget)
+    return budget
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    """
+    Raise OutOfTime in the block after ``seconds``. Uses SIGALRM, so it
+    only interrupts the main thread; elsewhere the block runs to the end.
+    """
+    if (threading.current_thread() is not threading.main_thread()
+            or not hasattr(signal, 'setitimer')):
+        yield
+        return
+
+    def interrupt(signum, frame):
+        raise OutOfTime()
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    outer, _ = signal.setitimer(signal.ITIMER_REAL, seconds)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        if outer:
+            # Restart the timer of an enclosing time_limit
+            elapsed = time.monotonic() - start
+            signal.setitimer(signal.ITIMER_REAL, max(outer - elapsed, 1e-6))
+
+
+def _call_without_budget(func, *args):
+    # In a worker, which may have been forked with the caller's deadline;
+    # the caller kills it if it runs out of time
+    _deadline.set(None)
+    return func(*args)
+
+
+def call_in_time(seconds, func, *args):
+    """
+    func(*args), raising OutOfTime after ``seconds``, or no limit if None.
+    Off the main thread, the call runs in worker_pool if there is one.
+    """
+    if seconds is None:
+        return func(*args)
+    if seconds <= 0:
+        raise OutOfTime()
+    if (threading.current_thread() is threading.main_thread()
+            and hasattr(signal, 'setitimer')):
+        with time_limit(seconds):
+            return func(*args)
+    if worker_pool is not None:
+        try:
+            return worker_pool.apply(_call_without_budget, func, *args,
+                                     timeout=seconds)
+        except WorkerTimeout:
+            raise OutOfTime()
+    return func(*args)
+
+
+def integrate_in_time(expr, symbol):
+    """sympy.integrate within the current budget; None if it runs out."""
+    try:
+        return call_in_time(remaining_time(), sympy.integrate, expr, symbol)
+    except OutOfTime:
+        return None
+
+
+# Need this to break loops; a context variable so that threads evaluating
+# different integrals don't see each other's
 # TODO: add manualintegrate flag to integrate
-_evaluating = None
+_evaluating = contextvars.ContextVar('evaluating', default=None)
 
 @evaluates(DontKnowRule)
 def eval_dontknow(context, symbol):
-    global _evaluating
-    if _evaluating == context:
+    if _evaluating.get() == context:
         return None
-    _evaluating = context
-    result = sympy.integrate(context, symbol)
-    _evaluating = None
+    token = _evaluating.set(context)
+    try:
+        result = integrate_in_time(context, symbol)
+    finally:
+        _evaluating.reset(token)
+    if result is None:
+        return sympy.Integral(context, symbol)
     return result
 
 
+@evaluates(TimeoutRule)
+def eval_timeout(context, symbol):
+    return sympy.Integral(context, symbol)
+
+
+class ContextDict(collections.abc.MutableMapping):
+    """A dict of which each thread (each context) sees its own copy."""
+    def __init__(self, name):
+        self._dict = contextvars.ContextVar(name)
+
+    def get_dict(self):
+        try:
+            return self._dict.get()
+        except LookupError:
+            d = {}
+            self._dict.set(d)
+            return d
+
+    def __getitem__(self, key):
+        return self.get_dict()[key]
+
+    def __setitem__(self, key, value):
+        self.get_dict()[key] = value
+
+    def __delitem__(self, key):
+        del self.get_dict()[key]
+
+    def __iter__(self):
+        return iter(self.get_dict())
+
+    def __len__(self):
+        return len(self.get_dict())
+
+
+# integral_steps marks the integrals it is working on in a module-level
+# dict to detect cycles, so two threads working on the same subintegral
+# would each take the other's for a cycle. Give each thread its own, so
+# that threads find steps in parallel; this is the only state it shares
+# (SymPy's cacheit caches hold results, the same in every thread).
+_manualintegrate_module = importlib.import_module(
+    'sympy.integrals.manualintegrate')
+if not isinstance(_manualintegrate_module._integral_cache, ContextDict):
+    _manualintegrate_module._integral_cache = ContextDict('integral_cache')
+
+def _budgeted(integral_steps):
+    """
+    Wrap integral_steps, which calls itself for every subintegral, to give
+    up with a TimeoutRule once the budget is spent.
+    """
+    @functools.wraps(integral_steps)
+    def budgeted_integral_steps(integrand, symbol, **options):
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            return TimeoutRule(integrand, symbol)
+        try:
+            rule = integral_steps(integrand, symbol, **options)
+        except BaseException:
+            # Don't leave the integral marked as in progress (a cycle)
+            _manualintegrate_module._integral_cache.pop(
+                (integrand, symbol), None)
+            raise
+        if type(rule) is DontKnowRule and remaining is not None and \
+                remaining_time() <= 0:
+            # Its subintegrals may have been cut short
+            return TimeoutRule(*rule)
+        return rule
+    return budgeted_integral_steps
+
+if not hasattr(_manualintegrate_module.integral_steps, '__wrapped__'):
+    _manualintegrate_module.integral_steps = _budgeted(
+        _manualintegrate_module.integral_steps)
+integral_steps = _manualintegrate_module.integral_steps
+
+
 def contains_dont_know(rule):
     if isinstance(rule, DontKnowRule):
         return True
@@ -79,6 +308,8 @@ class IntegralPrinter(stepprinter.HTMLPrinter):
             self.print_Arctan(rule)
         elif isinstance(rule, AlternativeRule):
             self.print_Alternative(rule)
+        elif isinstance(rule, TimeoutRule):
+            self.print_Timeout(rule)
         elif isinstance(rule, DontKnowRule):
             self.print_DontKnow(rule)
         elif isinstance(rule, RewriteRule):
@@ -138,7 +369,8 @@ class IntegralPrinter(stepprinter.HTMLPrinter):
     def print_U(self, rule):
         with self.new_step(), self.new_u_vars() as (u, du):
             # commutative always puts the symbol at the end when printed
-            dx = sympy.Symbol('d' + rule.symbol.name, commutative=0)
+            dx = sympy.Symbol('d' + self.rename(rule.symbol).name,
+                              commutative=0)
             self.append("Let {}.".format(
                 self.format_math(sympy.Eq(u, rule.u_func))))
             self.append("Then let {} and substitute {}:".format(
@@ -152,9 +384,9 @@ class IntegralPrinter(stepprinter.HTMLPrinter):
             self.append(self.format_math_display(
                 sympy.Integral(integrand, u)))
 
-            with self.new_level():
-                self.print_rule(replace_u_var(
-                    rule.substep, rule.symbol.name, u))
+            with self.new_level(), self.renamed(
+                    sympy.Symbol(self.rename(rule.symbol).name), u):
+                self.print_rule(rule.substep)
 
             self.append('<div class="collapsible"><h2>open answer</h2><ol class="content">Now replace {} to get:'.format(
                 self.format_math(u)))
@@ -291,17 +523,28 @@ class IntegralPrinter(stepprinter.HTMLPrinter):
             self.print_rule(rule.substep)
 
     def print_DontKnow(self, rule):
+        answer = integrate_in_time(rule.context, rule.symbol)
+        if answer is None:
+            self.print_Timeout(rule)
+            return
         with self.new_step():
             self.append("Don't know the steps in finding this integral.")
             self.append("But the integral is")
+            self.append(self.format_math_display(answer))
+
+    def print_Timeout(self, rule):
+        with self.new_step():
+            self.append("Could not finish this sub-integral in time:")
             self.append(self.format_math_display(
-                sympy.integrate(rule.context, rule.symbol)))
+                sympy.Integral(rule.context, rule.symbol)))
 
 
 class HTMLPrinter(IntegralPrinter, stepprinter.HTMLPrinter):
-    def __init__(self, rule):
+    def __init__(self, rule, on_flush=None):
         self.alternative_functions_printed = set()
-        stepprinter.HTMLPrinter.__init__(self)
+        # Whether simplifying the answer ran out of time, see simplify
+        self.cut_short = False
+        stepprinter.HTMLPrinter.__init__(self, on_flush)
         IntegralPrinter.__init__(self, rule)
 
     def print_Alternative(self, rule):
@@ -326,13 +569,13 @@ class HTMLPrinter(IntegralPrinter, stepprinter.HTMLPrinter):
 
     def format_math_constant(self, math):
         return '<script type="math/tex; mode=display">{}</script>'.format(
-            sympy.latex(math) + r'+ \mathrm{C}')
+            latex(self.rename(math), 'printer_display') + r'+ \mathrm{C}')
 
     def finalize(self):
         rule = filter_unknown_alternatives(self.rule)
         answer = _manualintegrate(rule)
         if answer:
-            simp = sympy.simplify(sympy.trigsimp(answer))
+            simp = self.simplify(answer)
             if simp != answer:
                 answer = simp
                 with self.new_step():
@@ -345,14 +588,51 @@ class HTMLPrinter(IntegralPrinter, stepprinter.HTMLPrinter):
                 self.append(self.format_math_constant(answer) + '</ol></div>')
         self.lines.append('</ol>')
         self.level = 0
+        self.flush()
         # self.append('The answer is:')
         # self.append(self.format_math_constant(answer))
         return '\n'.join(self.lines)
 
-
-def print_html_steps(function, symbol):
-    rule = integral_steps(function, symbol)
-    if isinstance(rule, DontKnowRule):
-        raise ValueError("Cannot evaluate integral")
-    a = HTMLPrinter(rule)
-    return a.finalize()
+    def simplify(self, answer):
+        """
+        Simplify the answer if that is likely to shorten it, within
+        SIMPLIFY_TIME_LIMIT and the budget; otherwise leave it as is. An
+        answer left as is for lack of time marks the steps cut_short.
+        """
+        if not likely_to_shrink(answer):
+            return answer
+        seconds = SIMPLIFY_TIME_LIMIT
+        remaining = remaining_time()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        try:
+            return call_in_time(seconds, simplify_answer, answer)
+        except OutOfTime:
+            self.cut_short = True
+            return answer
+
+
+def simplify_answer(answer):
+    return sympy.simplify(sympy.trigsimp(answer))
+
+
+def print_html_steps(function, symbol, on_flush=None, budget=None):
+    """
+    The steps of the integral of ``function`` as HTML. With a ``budget`` in
+    seconds, the steps not found in time are marked as such. If the budget
+    ran out, or simplifying the answer did, the HTML is returned as a
+    stepstore.Partial, so that the answer found with time to spare is the
+    one stored.
+    """
+    with time_budget(budget):
+        rule = integral_steps(function, symbol)
+        if isinstance(rule, DontKnowRule) and \
+                not isinstance(rule, TimeoutRule):
+            raise ValueError("Cannot evaluate integral")
+        a = HTMLPrinter(rule, on_flush)
+        html = a.finalize()
+        remaining = remaining_time()
+        if a.cut_short or remaining is not None and remaining <= 0:
+            # Some of the search may have been cut short
+            return Partial(html)
+        return html
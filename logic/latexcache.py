@@ -0,0 +1,60 @@
+import collections
+import threading
+
+import sympy
+
+from logic.cache import LRUCache
+from logic.timing import stage
+
+# LaTeX of SymPy expressions rendered before, keyed on the type and value of
+# the expression and the printer settings
+latex_cache = LRUCache(max_entries=8192, max_bytes=8 * 1024 * 1024)
+
+_site_counts = collections.defaultdict(lambda: {'hits': 0, 'misses': 0})
+_site_lock = threading.Lock()
+
+
+def _count(site, outcome):
+    with _site_lock:
+        _site_counts[site][outcome] += 1
+
+
+def latex(expr, site='other', **settings):
+    """
+    sympy.latex, cached across requests and printers.
+
+    site -- Name of the call site, for the counters in latex_stats()
+
+    Only SymPy objects go through the cache: Python containers compare
+    equal with different contents, like (1, 2.0) and (1, 2), or (True,)
+    and (1,). Those, mutable matrices, and calls with settings that can't
+    be hashed are rendered without it.
+    """
+    key = None
+    if isinstance(expr, sympy.Basic):
+        key = (type(expr), expr, tuple(sorted(settings.items())))
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+    if key is None:
+        _count(site, 'misses')
+        with stage('latex'):
+            return sympy.latex(expr, **settings)
+
+    result = latex_cache.get(key)
+    if result is None:
+        _count(site, 'misses')
+        with stage('latex'):
+            result = sympy.latex(expr, **settings)
+        latex_cache.set(key, result)
+    else:
+        _count(site, 'hits')
+    return result
+
+
+def latex_stats():
+    """Counters of the cache, and hits and misses by call site."""
+    with _site_lock:
+        sites = {site: dict(counts) for site, counts in _site_counts.items()}
+    return {'cache': latex_cache.stats(), 'sites': sites}
@@ -1,19 +1,29 @@
 import traceback
-from logic.utils import Eval, latexify, arguments, removeSymPy, OTHER_SYMPY_FUNCTIONS
+from logic.utils import Eval, Namespace, latexify, evaluate_input, \
+    removeSymPy, OTHER_SYMPY_FUNCTIONS
+from logic.cache import LRUCache
+from logic.pool import WorkerTimeout
 
 from logic.resultsets import find_result_set, get_card, format_by_type, \
     is_function_handled
-from sympy import latex
+from logic.latexcache import latex
+from logic import intsteps, numeric, timing
     
 import sympy
 
 from sympy.core.function import FunctionClass
-from sympy.parsing.sympy_parser import stringify_expr, parse_expr, \
+from sympy.parsing.sympy_parser import stringify_expr, \
     standard_transformations, convert_xor, TokenError,\
     implicit_multiplication, split_symbols, implicit_multiplication_application,\
     function_exponentiation, implicit_application
 
-PREEXEC = """from sympy import *"""
+TRANSFORMATIONS = (standard_transformations +
+    (implicit_multiplication, convert_xor, function_exponentiation,
+    split_symbols,implicit_application,implicit_multiplication_application,))
+
+# Cards for inputs seen before, keyed on the stringified input so that
+# spacing, ^ vs ** and implicit multiplication all map to the same entry
+card_cache = LRUCache(max_entries=512, max_bytes=16 * 1024 * 1024)
 
 def make_latex_readable(*args):
     latex_code = []
@@ -21,7 +31,7 @@ def make_latex_readable(*args):
         if hasattr(obj, 'as_latex'):
             latex_code.append(obj.as_latex())
         else:
-            latex_code.append(latex(obj))
+            latex_code.append(latex(obj, 'result'))
 
     tag = '<script type="math/tex; mode=display">'
     if len(args) == 1:
@@ -33,20 +43,81 @@ def make_latex_readable(*args):
                 hasattr(obj, 'evalf')):
             tag = '<script type="math/tex; mode=display" data-numeric="true" ' \
                   'data-output-repr="{}" data-approximation="{}">'.format(
-                      repr(obj), latex(obj.evalf(15)))
+                      repr(obj), latex(obj.evalf(15), 'approximation'))
 
     latex_code = ''.join(latex_code)
 
     return ''.join([tag, latex_code, '</script>'])
 
 
+def _compute_cards(s, parsed=None):
+    return UserInput().compute_cards(s, parsed)
+
+
+def _evaluate_card(card_name, expression, variable, parameters):
+    return UserInput().evaluate_card(card_name, expression, variable,
+                                     parameters)
+
+
+def _evaluate_cards(cards, expression, variable):
+    return UserInput().evaluate_cards(cards, expression, variable)
+
+
+def _definite_integrals(integrand, variable, bounds):
+    return UserInput().definite_integrals(integrand, variable, bounds)
+
+
 class UserInput(object):
+    """
+    pool -- Optional logic.pool.WorkerPool to evaluate cards in
+    """
+    def __init__(self, pool=None):
+        self.pool = pool
 
     def change_to_cards(self, s):
+        # The key is the normalized input, so it's evaluated as is on a miss
+        key = self.cache_key(s)
+        if key is not None:
+            cards = card_cache.get(key)
+            if cards is not None:
+                return [dict(card) for card in cards]
+
+        if self.pool is not None:
+            try:
+                with timing.stage('pool'):
+                    cards = self.pool.apply(_compute_cards, s, key)
+            except WorkerTimeout as e:
+                return [
+                    {"title": "Input", "input": s},
+                    {"title": "Error", "input": s, "error": str(e)}
+                ]
+        else:
+            cards = self.compute_cards(s, key)
+        if key is not None and cards and not self.is_error(cards):
+            card_cache.set(key, [dict(card) for card in cards])
+        return cards
+
+    def cache_key(self, s):
+        if not len(s):
+            return None
+        try:
+            return self.normalize_input(s, Namespace())
+        except Exception:
+            # Let compute_cards report the error
+            return None
+
+    def is_error(self, cards):
+        return any(card.get('title') == 'Error' for card in cards)
+
+    def normalize_input(self, s, namespace):
+        with timing.stage('stringify'):
+            return stringify_expr(s, {}, namespace, TRANSFORMATIONS)
+
+    def compute_cards(self, s, parsed=None):
         result = None
 
         try:
-            result = self.evaluate_user_input(s)
+            result = self.evaluate_user_input(s, parsed)
         except TokenError:
             return [
                 {"title": "Input", "input": s},
@@ -94,26 +165,27 @@ class UserInput(object):
                 {"title": "Error", "input": s, "error": trace}
             ]
 
-    def evaluate_user_input(self, s):
-        namespace = {}
-        exec(PREEXEC, namespace)
+    def evaluate_user_input(self, s, parsed=None):
+        """
+        parsed -- ``s`` as normalize_input gives it, if already known
+        """
+        namespace = Namespace()
         evaluator = Eval(namespace)
 
         if not len(s):
             return None
 
-        transformations = (standard_transformations +
-            (implicit_multiplication, convert_xor, function_exponentiation,
-            split_symbols,implicit_application,implicit_multiplication_application,))
-        parsed = stringify_expr(s, {}, namespace, transformations)
+        if parsed is None:
+            parsed = self.normalize_input(s, namespace)
         try:
-            evaluated = parse_expr(parsed, evaluate=True)
+            with timing.stage('evaluate'):
+                arguments, evaluated = evaluate_input(parsed, evaluator)
         except SyntaxError:
             raise
         except Exception as e:
             raise ValueError(str(e))
 
-        return parsed, arguments(parsed, evaluator), evaluator, evaluated
+        return parsed, arguments, evaluator, evaluated
 
     def get_cards_and_components(self, arguments, evaluator, evaluated):
         first_func_name = arguments[0]
@@ -131,12 +203,14 @@ class UserInput(object):
             first_func_name and first_func_name[0].islower() and
             not first_func_name in OTHER_SYMPY_FUNCTIONS)
 
-        if is_applied:
-            convert_input, cards = find_result_set(arguments[0], evaluated)
-        else:
-            convert_input, cards = find_result_set(None, evaluated)
+        with timing.stage('result_set'):
+            if is_applied:
+                convert_input, cards = find_result_set(arguments[0],
+                                                       evaluated)
+            else:
+                convert_input, cards = find_result_set(None, evaluated)
 
-        components = convert_input(arguments, evaluated)
+            components = convert_input(arguments, evaluated)
         if 'input_evaluated' in components:
             evaluated = components['input_evaluated']
 
@@ -183,35 +257,142 @@ class UserInput(object):
             for card_name in cards:
                 card = get_card(card_name)
 
-                if not card:
+                if not card or not card.applies_to(components):
                     continue
 
                 try:
-                    result.append({
-                        'card': card_name,
-                        'var': repr(var),
-                        'title': card.format_title(evaluated),
-                        'input': card.format_input(repr(evaluated), components),
-                        'pre_output': latex(
-                            card.pre_output_function(evaluated, var)),
-                        'parameters': card.card_info.get('parameters', [])
-                    })
+                    with timing.stage('card.' + card_name):
+                        result.append({
+                            'card': card_name,
+                            'var': repr(var),
+                            'title': card.format_title(evaluated),
+                            'input': card.format_input(repr(evaluated),
+                                                       components),
+                            'pre_output': latex(
+                                card.pre_output_function(evaluated, var),
+                                'pre_output'),
+                            'parameters': card.card_info.get('parameters', [])
+                        })
                 except:
                     pass
         return result
 
     def evaluate_card(self, card_name, expression, variable, parameters):
+        if self.pool is not None:
+            try:
+                return self.pool.apply(_evaluate_card, card_name, expression,
+                                       variable, parameters)
+            except WorkerTimeout as e:
+                return {'error': str(e)}
+
         card = get_card(card_name)
 
         if not card:
             raise KeyError
 
+        evaluator, components = self.prepare_card_evaluation(expression,
+                                                             variable)
+        with timing.stage('card.' + card_name):
+            return self.evaluate_prepared_card(card, evaluator, components,
+                                               parameters)
+
+    def evaluate_cards(self, cards, expression, variable):
+        """
+        Evaluate several cards for one expression, parsing it once and
+        sharing one evaluator between the cards.
+
+        cards -- List of (card name, parameters) pairs
+
+        Returns a list with a result, or a dict with an 'error', per card.
+        """
+        if self.pool is not None:
+            try:
+                return self.pool.apply(_evaluate_cards, cards, expression,
+                                       variable)
+            except WorkerTimeout as e:
+                return [{'error': str(e)} for _ in cards]
+
+        evaluator, components = self.prepare_card_evaluation(expression,
+                                                             variable)
+        results = []
+        for card_name, parameters in cards:
+            card = get_card(card_name)
+            if not card:
+                results.append({'error': 'Unknown card: ' + card_name})
+                continue
+            try:
+                with timing.stage('card.' + card_name):
+                    results.append(self.evaluate_prepared_card(
+                        card, evaluator, components, parameters))
+            except ValueError as e:
+                results.append({'error': str(e)})
+            except Exception:
+                trace = traceback.format_exc(5)
+                results.append({
+                    'error': ('There was an error. For reference'
+                              'the last five traceback entries are: ' + trace)
+                })
+        return results
+
+    def definite_integrals(self, integrand, variable, bounds):
+        """
+        Integrate one integrand between many bounds, finding its
+        antiderivative once (see logic.numeric.definite_integrals).
+
+        bounds -- List of (lower, upper) pairs of numbers or expressions
+
+        Returns a list with a result, or a dict with an 'error', per pair.
+        """
+        if self.pool is not None:
+            try:
+                return self.pool.apply(_definite_integrals, integrand,
+                                       variable, bounds)
+            except WorkerTimeout as e:
+                return [{'error': str(e)} for _ in bounds]
+
+        _, _, _, integrand = self.evaluate_user_input(integrand)
+        if not isinstance(integrand, sympy.Basic):
+            raise ValueError('The integrand must be an expression')
+        pairs = [tuple(self.evaluate_bound(bound) for bound in pair)
+                 for pair in bounds]
+        with intsteps.time_budget(intsteps.default_budget):
+            return numeric.definite_integrals(
+                integrand, sympy.Symbol(variable), pairs)
+
+    def evaluate_bound(self, bound):
+        if isinstance(bound, (int, float)):
+            return sympy.sympify(bound)
+        result = self.evaluate_user_input(str(bound))
+        if result is None or not isinstance(result[3], sympy.Basic):
+            raise ValueError('Invalid bound: {}'.format(bound))
+        return result[3]
+
+    def stream_card(self, card_name, expression, variable, parameters):
+        """
+        Yield the output of a card in chunks as it is printed. Only cards
+        with a stream_method (the step cards) can be streamed, and they
+        are not run in the worker pool. The steps are all found before the
+        first chunk, so streaming spreads out the printing, not the search.
+        """
+        card = get_card(card_name)
+
+        if not card or not card.can_stream():
+            raise KeyError
+
+        evaluator, components = self.prepare_card_evaluation(expression,
+                                                             variable)
+        return card.stream(evaluator, components, parameters)
+
+    def prepare_card_evaluation(self, expression, variable):
         _, arguments, evaluator, evaluated = self.evaluate_user_input(expression)
         variable = sympy.Symbol(variable)
         components, _, evaluated, _ = self.get_cards_and_components(
             arguments, evaluator, evaluated)
         components['variable'] = variable
         evaluator.set(str(variable), variable)
+        return evaluator, components
+
+    def evaluate_prepared_card(self, card, evaluator, components, parameters):
         result = card.eval(evaluator, components, parameters)
 
         return {
@@ -0,0 +1,390 @@
+"""
+Numeric values of definite integrals, for when the symbolic result is slow
+or out of reach.
+"""
+import threading
+import warnings
+
+import numpy
+import scipy.integrate
+import scipy.special
+import sympy
+
+from logic import intsteps
+from logic.cache import LRUCache
+
+# Antiderivatives found for definite_integrals, keyed on the integrand and
+# the variable; None when SymPy can't find one
+antiderivative_cache = LRUCache(max_entries=256)
+
+# A result whose estimated error is larger than this, relative to the
+# value (or absolute, for values under 1), isn't taken for the value
+MAX_RELATIVE_ERROR = 1e-6
+
+# quad reports that an integral diverges or didn't converge in its return
+# value (full_output), but nquad only in warnings. catch_warnings changes
+# process-wide state, so one thread at a time records them.
+_nquad_lock = threading.Lock()
+
+
+def is_definite(limits):
+    """Whether every limit is a (variable, lower, upper) triple."""
+    return bool(limits) and all(
+        isinstance(limit, tuple) and len(limit) == 3 for limit in limits)
+
+
+def free_parameters(integrand, limits):
+    """Symbols other than the variables of integration the integral has."""
+    variables = set(limit[0] for limit in limits)
+    bounds = [sympy.sympify(bound) for limit in limits for bound in limit[1:]]
+    return integrand.free_symbols.union(
+        *(bound.free_symbols for bound in bounds)) - variables
+
+
+def bounds_in_order(limits):
+    """
+    Whether the bounds of each integral only depend on the variables of the
+    integrals outside it, as in (x, 0, y), (y, 0, 1).
+    """
+    variables = [limit[0] for limit in limits]
+    for i, (_, lower, upper) in enumerate(limits):
+        symbols = (sympy.sympify(lower).free_symbols |
+                   sympy.sympify(upper).free_symbols)
+        if symbols & set(variables[:i + 1]):
+            return False
+    return True
+
+
+def has_numeric_value(integrand, limits):
+    return (is_definite(limits) and bounds_in_order(limits) and
+            not free_parameters(integrand, limits))
+
+
+def to_float(value):
+    if value == sympy.oo:
+        return numpy.inf
+    if value == -sympy.oo:
+        return -numpy.inf
+    return float(value)
+
+
+def quadrature(integrand, limits):
+    """
+    Integrate ``integrand`` numerically with SciPy's adaptive quadrature.
+
+    limits -- (variable, lower, upper) triples, innermost first, as for
+    sympy.Integral. The bounds may depend on the variables of the outer
+    integrals.
+
+    Returns the value and an estimate of its absolute error. Raises
+    ValueError if the integral diverges, at a pole or at infinity, or
+    SciPy can't make it converge.
+    """
+    if not is_definite(limits):
+        raise ValueError('Only definite integrals have a numeric value')
+    if not bounds_in_order(limits):
+        raise ValueError('The bounds of an integral may only depend on the '
+                         'variables of the integrals outside it')
+
+    variables = [limit[0] for limit in limits]
+    unknown = free_parameters(integrand, limits)
+    if unknown:
+        raise ValueError('The integral depends on {}, so it has no numeric '
+                         'value'.format(', '.join(sorted(map(str, unknown)))))
+
+    function = sympy.lambdify(variables, integrand, 'numpy')
+
+    def real(*point):
+        try:
+            value = complex(function(*point))
+        except (ZeroDivisionError, OverflowError):
+            return numpy.nan
+        if value.imag:
+            raise ValueError('The integrand is not real on the interval')
+        return value.real
+
+    ranges = []
+    for i, (_, lower, upper) in enumerate(limits):
+        outer = variables[i + 1:]
+        lower, upper = sympy.sympify(lower), sympy.sympify(upper)
+        if (lower.free_symbols | upper.free_symbols) & set(outer):
+            bounds = sympy.lambdify(outer, (lower, upper), 'numpy')
+            ranges.append(lambda *point, bounds=bounds: [
+                to_float(bound) for bound in bounds(*point)])
+        else:
+            ranges.append((to_float(lower), to_float(upper)))
+
+    with numpy.errstate(all='ignore'):
+        if len(ranges) == 1 and not callable(ranges[0]):
+            lower, upper = ranges[0]
+            poles = inner_poles(integrand, variables[0], lower, upper)
+            if poles is None:
+                raise ValueError('The integral has no finite numeric value')
+            options = {'points': poles} if poles and numpy.isfinite(
+                [lower, upper]).all() else {}
+            result = scipy.integrate.quad(real, lower, upper, full_output=1,
+                                          **options)
+            # A message follows the infodict when quad gave up
+            value, error = result[:2]
+            converged = len(result) == 3
+        else:
+            with _nquad_lock, warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter(
+                    'always', scipy.integrate.IntegrationWarning)
+                value, error = scipy.integrate.nquad(real, ranges)
+            converged = not any(
+                issubclass(warning.category,
+                           scipy.integrate.IntegrationWarning)
+                for warning in caught)
+    if not (converged and numpy.isfinite(value) and
+            error <= MAX_RELATIVE_ERROR * max(abs(value), 1)):
+        raise ValueError('The integral has no finite numeric value')
+    return value, error
+
+
+def inner_poles(integrand, symbol, lower, upper):
+    """
+    The singular points of ``integrand`` strictly between the float bounds,
+    for quad to split the interval at. None if the integral diverges at a
+    singular point in the interval or at its ends; no points if they can't
+    be found.
+    """
+    points = singular_points(integrand, symbol)
+    if not points:
+        return []
+    low, high = min(lower, upper), max(lower, upper)
+    inner = []
+    for point in points:
+        value = float(point)
+        if low < value <= high and diverges_at(integrand, symbol, point, '-'):
+            return None
+        if low <= value < high and diverges_at(integrand, symbol, point, '+'):
+            return None
+        if low < value < high:
+            inner.append(value)
+    return sorted(inner)
+
+
+def diverges_at(expr, symbol, point, direction):
+    """
+    Whether the integral of ``expr`` diverges at ``point`` approached from
+    ``direction``, '+' or '-': whether ``expr`` grows like
+    1/(symbol - point) or faster there. False if SymPy can't tell.
+    """
+    try:
+        value = sympy.limit((symbol - point) * expr, symbol, point,
+                            dir=direction)
+    except Exception:
+        return False
+    if value in (sympy.oo, -sympy.oo, sympy.zoo):
+        return True
+    return bool(value.is_number and value != 0 and
+                not value.has(sympy.oo, -sympy.oo, sympy.zoo))
+
+
+_missing = object()
+
+# Functions finite and continuous on the whole real line, and functions
+# singular only where their argument is zero, like log; singular_points
+# gives up on expressions with any other function
+CONTINUOUS_FUNCTIONS = (
+    sympy.exp, sympy.sin, sympy.cos, sympy.atan, sympy.asinh, sympy.sinh,
+    sympy.cosh, sympy.erf, sympy.erfi, sympy.Si, sympy.Shi, sympy.fresnels,
+    sympy.fresnelc)
+LOG_LIKE_FUNCTIONS = (sympy.log, sympy.Ci, sympy.Chi, sympy.Ei)
+
+# NumPy versions of the special functions of antiderivatives, for lambdify
+SPECIAL_FUNCTIONS = {
+    'erf': scipy.special.erf,
+    'erfi': scipy.special.erfi,
+    'Si': lambda x: scipy.special.sici(x)[0],
+    'Ci': lambda x: scipy.special.sici(x)[1],
+    'Shi': lambda x: scipy.special.shichi(x)[0],
+    'Chi': lambda x: scipy.special.shichi(x)[1],
+    'Ei': scipy.special.expi,
+    'fresnels': lambda x: scipy.special.fresnel(x)[0],
+    'fresnelc': lambda x: scipy.special.fresnel(x)[1],
+}
+
+
+def antiderivative(integrand, symbol):
+    """
+    sympy.integrate within the current time budget, cached. None if SymPy
+    can't find the antiderivative, or not in time.
+    """
+    key = (integrand, symbol)
+    result = antiderivative_cache.get(key, _missing)
+    if result is not _missing:
+        return result
+
+    result = intsteps.integrate_in_time(integrand, symbol)
+    if result is None:
+        # Out of time; another request may have more
+        return None
+    if result.has(sympy.Integral):
+        result = None
+    antiderivative_cache.set(key, result)
+    return result
+
+
+def singular_points(expr, symbol):
+    """
+    The real points where ``expr`` may be singular or start to be complex,
+    as SymPy numbers:
+    the zeros of denominators, of the arguments of logarithms (and
+    LOG_LIKE_FUNCTIONS) and of the bases of roots. None if they can't be
+    found, like those of tan(x).
+    """
+    bases = []
+    for node in sympy.preorder_traversal(expr):
+        if isinstance(node, sympy.Pow) and not (node.exp.is_integer and
+                                                node.exp.is_positive):
+            bases.append(node.base)
+        elif isinstance(node, LOG_LIKE_FUNCTIONS):
+            bases.append(node.args[0])
+        elif isinstance(node, sympy.Function) and not isinstance(
+                node, CONTINUOUS_FUNCTIONS):
+            return None
+
+    points = set()
+    for base in bases:
+        if symbol not in base.free_symbols:
+            continue
+        try:
+            roots = sympy.solve(base, symbol)
+        except NotImplementedError:
+            return None
+        for root in roots:
+            if not root.is_number:
+                return None
+            if complex(root).imag == 0:
+                points.add(root)
+    return points
+
+
+def limit_of(expr, symbol, point, direction='+'):
+    """
+    The limit of ``expr`` at ``point``, a SymPy number or +-oo, approached
+    from ``direction``, as a complex number, or inf if it diverges. None if
+    SymPy can't find it, like the limit of sin(x) at oo.
+    """
+    try:
+        value = sympy.limit(expr, symbol, point, dir=direction)
+    except Exception:
+        return None
+    if value in (sympy.oo, -sympy.oo, sympy.zoo):
+        return numpy.inf
+    if not value.is_number or value.has(sympy.oo, -sympy.oo, sympy.zoo):
+        return None
+    return complex(value)
+
+
+def integrals_by_antiderivative(F, symbol, lower, upper, points):
+    """
+    F(upper) - F(lower) for arrays of bounds, with lower <= upper. At an
+    infinite bound, or a bound at one of the singular ``points``, F is
+    its one-sided limit there, and the jumps of F at the points between
+    the bounds are taken out. Each limit is found once for all the pairs.
+
+    F is evaluated at complex points, as antiderivatives like log(x - 2)
+    for 1/(x - 2) are complex, by a constant, on one side of a point.
+
+    Returns the values, NaN where they can't be found this way or aren't
+    real, and whether each integral diverges.
+    """
+    evaluate = sympy.lambdify(symbol, F, modules=[SPECIAL_FUNCTIONS, 'numpy'])
+    limits = {}
+
+    def one_sided(point, direction):
+        if (point, direction) not in limits:
+            limits[point, direction] = limit_of(F, symbol, point, direction)
+        value = limits[point, direction]
+        return numpy.nan if value is None else value
+
+    def at(bounds, direction):
+        with numpy.errstate(all='ignore'):
+            values = evaluate(numpy.where(numpy.isfinite(bounds), bounds,
+                                          0).astype(complex))
+        values = numpy.array(numpy.broadcast_to(values, len(bounds)),
+                             dtype=complex)
+        for end, point in ((numpy.inf, sympy.oo), (-numpy.inf, -sympy.oo)):
+            at_end = bounds == end
+            if at_end.any():
+                values[at_end] = one_sided(point, '-' if end > 0 else '+')
+        for point in points:
+            at_point = bounds == float(point)
+            if at_point.any():
+                values[at_point] = one_sided(point, direction)
+        return values
+
+    start, end = at(lower, '+'), at(upper, '-')
+    with numpy.errstate(all='ignore'):
+        values = end - start
+    diverges = numpy.isinf(start) | numpy.isinf(end)
+    for point in points:
+        inside = (lower < float(point)) & (float(point) < upper)
+        if not inside.any():
+            continue
+        right, left = one_sided(point, '+'), one_sided(point, '-')
+        if numpy.isinf([left, right]).any():
+            diverges |= inside
+        values[inside] -= right - left
+
+    real = abs(values.imag) <= 1e-9 * numpy.maximum(abs(values.real), 1)
+    return numpy.where(real, values.real, numpy.nan), diverges
+
+
+def definite_integrals(integrand, symbol, bounds):
+    """
+    The integral of ``integrand`` between each (lower, upper) pair of
+    ``bounds``, finding its antiderivative once and evaluating it at all
+    bounds at once with NumPy (see integrals_by_antiderivative). Pairs
+    it can't be used for are integrated numerically instead.
+
+    Returns a dict per pair with the 'value' and the 'method' used, with
+    the 'error_estimate' of quadrature, or with an 'error'.
+    """
+    if integrand.free_symbols - {symbol}:
+        raise ValueError('The integrand may only depend on ' + str(symbol))
+    bounds = [(sympy.sympify(lower), sympy.sympify(upper))
+              for lower, upper in bounds]
+    if any(bound.free_symbols for pair in bounds for bound in pair):
+        raise ValueError('The bounds must be numbers')
+
+    lower = numpy.array([to_float(pair[0]) for pair in bounds])
+    upper = numpy.array([to_float(pair[1]) for pair in bounds])
+    values = numpy.full(len(bounds), numpy.nan)
+    diverges = numpy.zeros(len(bounds), dtype=bool)
+
+    F = antiderivative(integrand, symbol)
+    points = None
+    if F is not None:
+        points = singular_points(integrand, symbol)
+        if points is not None:
+            more = singular_points(F, symbol)
+            points = None if more is None else points | more
+
+    if points is not None and len(bounds):
+        sign = numpy.where(lower <= upper, 1.0, -1.0)
+        values, diverges = integrals_by_antiderivative(
+            F, symbol, numpy.minimum(lower, upper),
+            numpy.maximum(lower, upper), points)
+        values *= sign
+
+    results = []
+    for (a, b), value, divergent in zip(bounds, values, diverges):
+        if divergent:
+            results.append(
+                {'error': 'The integral has no finite numeric value'})
+            continue
+        if numpy.isfinite(value):
+            results.append({'value': float(value), 'method': 'antiderivative'})
+            continue
+        try:
+            value, error = quadrature(integrand, [(symbol, a, b)])
+        except ValueError as e:
+            results.append({'error': str(e)})
+        else:
+            results.append({'value': value, 'error_estimate': error,
+                            'method': 'quadrature'})
+    return results
@@ -0,0 +1,158 @@
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+import time
+import traceback
+
+
+# Workers are forked from a fork server, a single-threaded process that
+# imports these first, rather than from the process using the pool, which
+# may be running other threads: a child forked while one of them holds a
+# lock (logging, a cache, sqlite) would wait on that lock forever.
+_context = multiprocessing.get_context('forkserver')
+_context.set_forkserver_preload(['logic.logic'])
+
+
+class WorkerTimeout(Exception):
+    """A call ran out of time or memory and its worker was replaced."""
+
+
+def _limit_cpu(seconds):
+    # RLIMIT_CPU counts the whole life of the process, so the budget is
+    # added to what the worker has used so far
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(used + seconds) + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _worker_main(connection, memory_limit):
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    while True:
+        try:
+            func, args, cpu_limit = connection.recv()
+        except EOFError:
+            return
+
+        if cpu_limit:
+            _limit_cpu(cpu_limit)
+
+        try:
+            result = ('ok', func(*args))
+        except MemoryError:
+            result = ('memory', None)
+        except Exception as e:
+            result = ('error', e)
+
+        try:
+            connection.send(result)
+        except Exception:
+            # The result or exception could not be pickled
+            connection.send(('error', RuntimeError(traceback.format_exc())))
+
+
+class Worker(object):
+    def __init__(self, context, memory_limit):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main,
+                                       args=(child_connection, memory_limit))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+
+    def kill(self):
+        self.connection.close()
+        self.process.kill()
+        self.process.join()
+
+
+class WorkerPool(object):
+    """
+    Pre-forked worker processes that evaluate calls under resource limits.
+
+    Workers are forked from the fork server, which the first process to
+    use a pool starts, so they start with SymPy and the card tables already
+    imported. That process must not fork afterwards (a gunicorn master
+    must not use a pool before forking its workers). A call that runs
+    past ``timeout`` seconds of wall clock time, ``cpu_limit`` seconds of CPU
+    time or ``memory_limit`` bytes of address space gets its worker killed
+    and replaced, and raises WorkerTimeout in the caller.
+
+    Functions and arguments are sent to the workers by pickling, so they
+    must be module level functions.
+    """
+    def __init__(self, processes=2, timeout=30, cpu_limit=None,
+                 memory_limit=None):
+        self.processes = processes
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+
+    def start(self):
+        with self._lock:
+            # A pool inherited through fork (e.g. by a gunicorn worker)
+            # can't talk to its parent's workers, so it starts its own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = queue.Queue()
+                for _ in range(self.processes):
+                    self._idle.put(self._start_worker())
+
+    def _start_worker(self):
+        return Worker(_context, self.memory_limit)
+
+    def apply(self, func, *args, timeout=None):
+        """
+        func(*args) in a worker, within ``timeout`` or the pool's. With a
+        ``timeout``, the wait for an idle worker counts against it.
+        """
+        self.start()
+        if timeout is None:
+            worker = self._idle.get()
+            timeout = self.timeout
+        else:
+            deadline = time.monotonic() + timeout
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise WorkerTimeout("This took too long to compute.")
+            timeout = max(deadline - time.monotonic(), 0)
+        try:
+            worker.connection.send((func, args, self.cpu_limit))
+            if not worker.connection.poll(timeout):
+                raise WorkerTimeout("This took too long to compute.")
+            status, value = worker.connection.recv()
+            if status == 'memory':
+                raise WorkerTimeout("This needed too much memory to compute.")
+        except WorkerTimeout:
+            worker.kill()
+            worker = self._start_worker()
+            raise
+        except (EOFError, OSError):
+            # The worker was killed, most likely by its CPU limit
+            worker.kill()
+            worker = self._start_worker()
+            raise WorkerTimeout("This took too long to compute.")
+        finally:
+            self._idle.put(worker)
+
+        if status == 'error':
+            raise value
+        return value
+
+    def close(self):
+        with self._lock:
+            if self._idle is not None and self._pid == os.getpid():
+                while not self._idle.empty():
+                    self._idle.get().kill()
+            self._pid = self._idle = None
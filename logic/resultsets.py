@@ -1,9 +1,13 @@
 import sys
+import collections
+import functools
 import sympy
 from sympy.core.symbol import Symbol
 import docutils.core
 from logic import diffsteps
 from logic import intsteps
+from logic import numeric
+from logic import stepstore
 
 
 class ResultCard(object):
@@ -65,9 +69,18 @@ class ResultCard(object):
                                                            input_evaluated)
         return self.title
 
+    def can_stream(self):
+        return 'stream_method' in self.card_info
+
     def is_multivariate(self):
         return self.card_info.get('multivariate', True)
 
+    def applies_to(self, components):
+        """Whether to show the card for an input with these components."""
+        if 'applies_to' in self.card_info:
+            return self.card_info['applies_to'](components)
+        return True
+
     def default_parameters(self, kwargs):
         if 'parameters' in self.card_info:
             for arg in self.card_info['parameters']:
@@ -93,6 +106,29 @@ class FakeResultCard(ResultCard):
             parameters = {}
         return self.card_info['eval_method'](evaluator, components, parameters)
 
+    def stream(self, evaluator, components, parameters=None):
+        """Yield chunks of the output of a card with a stream_method."""
+        if parameters is None:
+            parameters = {}
+        return self.card_info['stream_method'](evaluator, components,
+                                               parameters)
+
+
+class MultiResult(list):
+    """
+    (card, result) pairs of a MultiResultCard, with the input they were
+    evaluated for. Cards are shared between requests, so this state can't
+    live on the card.
+    """
+    def __init__(self, results, input_repr, components):
+        super(MultiResult, self).__init__(results)
+        self.input_repr = input_repr
+        self.components = components
+
+    @property
+    def cards_used(self):
+        return [card for card, _ in self]
+
 
 class MultiResultCard(ResultCard):
     """Tries multiple statements and displays the first that works."""
@@ -100,14 +136,10 @@ class MultiResultCard(ResultCard):
     def __init__(self, title, *cards):
         super(MultiResultCard, self).__init__(title, '', lambda *args: '')
         self.cards = cards
-        self.cards_used = []
 
     def eval(self, evaluator, components, parameters):
-        self.cards_used = []
         results = []
 
-        # TODO Implicit state is bad, come up with better API
-        # in particular a way to store variable, cards used
         for card in self.cards:
             try:
                 result = card.eval(evaluator, components, parameters)
@@ -115,12 +147,10 @@ class MultiResultCard(ResultCard):
                 continue
             if result != None:
                 if not any(result == r[1] for r in results):
-                    self.cards_used.append(card)
                     results.append((card, result))
         if results:
-            self.input_repr = evaluator.get("input_evaluated")
-            self.components = components
-            return results
+            return MultiResult(results, evaluator.get("input_evaluated"),
+                               components)
         return "None"
 
     def format_input(self, input_repr, components):
@@ -133,7 +163,8 @@ class MultiResultCard(ResultCard):
         for card, result in output:
             html.append('<li id="changedisplaytonone2">')
             html.append('<div class="cell_input">')
-            html.append(card.format_input(self.input_repr, self.components))
+            html.append(card.format_input(output.input_repr,
+                                          output.components))
             html.append('</div>')
             html.append(card.format_output(result, formatter))
             html.append('<script type="math/tex; mode=display"> \mathrm{with\;constant = C}</script>')
@@ -144,56 +175,79 @@ class MultiResultCard(ResultCard):
 
 # Decide which result card set to use
 
-def is_derivative(input_evaluated):
-    return isinstance(input_evaluated, sympy.Derivative)
+TRIG_FUNCTIONS = (sympy.sin, sympy.cos, sympy.tan,
+                  sympy.csc, sympy.sec, sympy.cot)
+LOGIC_FUNCTIONS = (sympy.And, sympy.Or, sympy.Not, sympy.Xor)
 
-def is_integral(input_evaluated):
-    return isinstance(input_evaluated, sympy.Integral)
+ExpressionFeatures = collections.namedtuple(
+    'ExpressionFeatures', 'expr head types free_symbols is_constant')
 
-def is_numbersymbol(input_evaluated):
-    return isinstance(input_evaluated, sympy.NumberSymbol)
+def analyze_expression(input_evaluated):
+    """
+    Walk the evaluated input once and record what the result set predicates
+    look at: its type, the types of all its subexpressions (functions
+    included), its free symbols and whether it is constant.
+    """
+    types = frozenset()
+    if isinstance(input_evaluated, sympy.Basic):
+        try:
+            types = frozenset(type(node) for node in
+                              sympy.preorder_traversal(input_evaluated))
+        except AttributeError:
+            pass
 
-def is_constant(input_evaluated):
     # is_constant reduces trig identities (even with simplify=False?) so we
     # check free_symbols instead
-    return (hasattr(input_evaluated, 'free_symbols') and
-            not input_evaluated.free_symbols)
+    free_symbols = getattr(input_evaluated, 'free_symbols', None)
+    is_constant = (hasattr(input_evaluated, 'free_symbols') and
+                   not free_symbols)
+
+    return ExpressionFeatures(input_evaluated, type(input_evaluated), types,
+                              free_symbols, is_constant)
+
+def has_function(features, functions):
+    return any(issubclass(t, functions) for t in features.types)
+
+def is_derivative(features):
+    return issubclass(features.head, sympy.Derivative)
+
+def is_integral(features):
+    return issubclass(features.head, sympy.Integral)
+
+def is_numbersymbol(features):
+    return issubclass(features.head, sympy.NumberSymbol)
+
+def is_constant(features):
+    return features.is_constant
 
-def is_approximatable_constant(input_evaluated):
+def is_approximatable_constant(features):
     # is_constant, but exclude Integer/Float/infinity
-    return (hasattr(input_evaluated, 'free_symbols') and
-            not input_evaluated.free_symbols and
-            not input_evaluated.is_Integer and
-            not input_evaluated.is_Float and
-            input_evaluated.is_finite is not True)
+    return (features.is_constant and
+            not features.expr.is_Integer and
+            not features.expr.is_Float and
+            features.expr.is_finite is not True)
 
-def is_trig(input_evaluated):
-    try:
-        if (isinstance(input_evaluated, sympy.Basic) and
-            any(input_evaluated.find(func)
-                for func in (sympy.sin, sympy.cos, sympy.tan,
-                             sympy.csc, sympy.sec, sympy.cot))):
-            return True
-    except AttributeError:
-        pass
-    return False
+def is_trig(features):
+    return (issubclass(features.head, sympy.Basic) and
+            has_function(features, TRIG_FUNCTIONS))
 
-def is_not_constant_basic(input_evaluated):
-    return (not is_constant(input_evaluated) and
-            isinstance(input_evaluated, sympy.Basic) and
-            not is_logic(input_evaluated))
+def is_not_constant_basic(features):
+    return (not is_constant(features) and
+            issubclass(features.head, sympy.Basic) and
+            not is_logic(features))
 
-def is_uncalled_function(input_evaluated):
-    return hasattr(input_evaluated, '__call__') and not isinstance(input_evaluated, sympy.Basic)
+def is_uncalled_function(features):
+    return (hasattr(features.expr, '__call__') and
+            not issubclass(features.head, sympy.Basic))
 
-def is_logic(input_evaluated):
-    return isinstance(input_evaluated, (sympy.And, sympy.Or, sympy.Not, sympy.Xor))
+def is_logic(features):
+    return issubclass(features.head, LOGIC_FUNCTIONS)
 
-def is_sum(input_evaluated):
-    return isinstance(input_evaluated, sympy.Sum)
+def is_sum(features):
+    return issubclass(features.head, sympy.Sum)
 
-def is_product(input_evaluated):
-    return isinstance(input_evaluated, sympy.Product)
+def is_product(features):
+    return issubclass(features.head, sympy.Product)
 
 
 # Functions to convert input and extract variable used
@@ -296,6 +350,11 @@ def format_integral(line, result, components):
 
     return line.format(_var=limits) % components['integrand']
 
+def format_quadrature(result, formatter):
+    value, error = result
+    return ('<script type="math/tex; mode=display">\\approx {:.15g}</script>'
+            '<p>Estimated error: {:.1e}</p>').format(value, error)
+
 def format_function_docs_input(line, function, components):
     function = getattr(components['input_evaluated'], '__name__', str(function))
     return line % function
@@ -353,6 +412,9 @@ def format_nested_list_title(*titles):
 def eval_integral(evaluator, components, parameters=None):
     return sympy.integrate(components['integrand'], *components['limits'])
 
+def eval_integral_numeric(evaluator, components, parameters=None):
+    return numeric.quadrature(components['integrand'], components['limits'])
+
 def eval_integral_manual(evaluator, components, parameters=None):
     return sympy.integrals.manualintegrate(components['integrand'],
                                            components['variable'])
@@ -360,13 +422,35 @@ def eval_integral_manual(evaluator, components, parameters=None):
 def eval_diffsteps(evaluator, components, parameters=None):
     function = components.get('function', evaluator.get('input_evaluated'))
 
-    return diffsteps.print_html_steps(function,
-                                      components['variable'])
+    return stepstore.cached_steps('diffsteps', diffsteps.STEPS_VERSION,
+                                  function, components['variable'],
+                                  diffsteps.print_html_steps)
+
+def budgeted_intsteps(parameters):
+    """print_html_steps with the card's budget parameter."""
+    budget = intsteps.parse_budget((parameters or {}).get('budget'))
+    return functools.partial(intsteps.print_html_steps, budget=budget)
 
 def eval_intsteps(evaluator, components, parameters=None):
     integrand = components.get('integrand', evaluator.get('input_evaluated'))
 
-    return intsteps.print_html_steps(integrand, components['variable'])
+    return stepstore.cached_steps('intsteps', intsteps.STEPS_VERSION,
+                                  integrand, components['variable'],
+                                  budgeted_intsteps(parameters))
+
+def stream_diffsteps(evaluator, components, parameters=None):
+    function = components.get('function', evaluator.get('input_evaluated'))
+
+    return stepstore.stream_cached_steps('diffsteps', diffsteps.STEPS_VERSION,
+                                         function, components['variable'],
+                                         diffsteps.print_html_steps)
+
+def stream_intsteps(evaluator, components, parameters=None):
+    integrand = components.get('integrand', evaluator.get('input_evaluated'))
+
+    return stepstore.stream_cached_steps('intsteps', intsteps.STEPS_VERSION,
+                                         integrand, components['variable'],
+                                         budgeted_intsteps(parameters))
 
 # https://www.python.org/dev/peps/pep-0257/
 def trim(docstring):
@@ -417,6 +501,16 @@ all_cards = {
         format_input_function=format_integral
     ),
 
+    'integral_numeric': FakeResultCard(
+        "Numeric Value",
+        "integrate(%s, {_var})",
+        no_pre_output,
+        eval_method=eval_integral_numeric,
+        format_output_function=format_quadrature,
+        format_input_function=format_integral,
+        applies_to=lambda components: numeric.has_numeric_value(
+            components['integrand'], components['limits'])),
+
     'integral_manual': ResultCard(
         "Integral",
         "sympy.integrals.manualintegrate(%s, {_var})",
@@ -435,7 +529,8 @@ all_cards = {
         "diff(%s, {_var})",
         no_pre_output,
         format_output_function=format_steps,
-        eval_method=eval_diffsteps),
+        eval_method=eval_diffsteps,
+        stream_method=stream_diffsteps),
 
     'intsteps': FakeResultCard(
         "Integral Steps",
@@ -443,7 +538,9 @@ all_cards = {
         no_pre_output,
         format_output_function=format_steps,
         eval_method=eval_intsteps,
-        format_input_function=format_integral),
+        stream_method=stream_intsteps,
+        format_input_function=format_integral,
+        parameters=['budget']),
 
     'satisfiable': ResultCard(
         "Satisfiability",
@@ -470,8 +567,8 @@ Syntax:
 
 predicate: str or func
   If a string, names a function that uses this set of result cards.
-  If a function, the function, given the evaluated input, returns True if
-  this set of result cards should be used.
+  If a function, the function, given the ExpressionFeatures of the evaluated
+  input, returns True if this set of result cards should be used.
 
 extract_components: None or func
   If None, use the default function.
@@ -486,7 +583,8 @@ result_cards: None or list
   If a list, specifies a list of result cards to display.
 """
 result_sets = [
-    ('integrate', extract_integral, ['integral_alternate_fake', 'intsteps']),
+    ('integrate', extract_integral,
+     ['integral_numeric', 'integral_alternate_fake', 'intsteps']),
     ('diff', extract_derivative, ['diff', 'diffsteps']),
     ('help', extract_first, ['function_docs']),
     ('rsolve', None, None),
@@ -502,11 +600,62 @@ result_sets = [
     (is_not_constant_basic, None, [ 'diff', 'integral_alternate'])
 ]
 
+class ResultSetIndex(object):
+    """
+    Index of result_sets by function name, so a lookup only runs the
+    predicates and visits the entries that can match.
+
+    Rebuild it if result_sets changes.
+    """
+    def __init__(self, result_sets):
+        self.result_sets = list(result_sets)
+        self.names = collections.defaultdict(list)
+        self.predicates = []
+        for position, (predicate, _, _) in enumerate(self.result_sets):
+            if callable(predicate):
+                self.predicates.append((position, predicate))
+            else:
+                self.names[predicate].append(position)
+        self._resolved = {}
+
+    def matches(self, function_name, features):
+        positions = list(self.names.get(function_name, ()))
+        positions.extend(position for position, predicate in self.predicates
+                         if predicate(features))
+        positions.sort()
+        return tuple(positions)
+
+    def resolve(self, positions):
+        # The matching entries decide the result, so it is computed once
+        # per combination
+        if positions not in self._resolved:
+            result = []
+            result_converter = default_variable
+
+            for position in positions:
+                _, converter, result_cards = self.result_sets[position]
+                if converter:
+                    result_converter = converter
+                if result_cards is None:
+                    break
+                for card in result_cards:
+                    if card not in result:
+                        result.append(card)
+
+            self._resolved[positions] = (result_converter, tuple(result))
+        return self._resolved[positions]
+
+    def handles(self, function_name):
+        return any(self.result_sets[position][2] is not None
+                   for position in self.names.get(function_name, ()))
+
+result_set_index = ResultSetIndex(result_sets)
+
 def is_function_handled(function_name):
     """Do any of the result sets handle this specific function?"""
     if function_name == "simplify":
         return True
-    return any(name == function_name for (name, _, cards) in result_sets if cards is not None)
+    return result_set_index.handles(function_name)
 
 def find_result_set(function_name, input_evaluated):
     """
@@ -519,25 +668,8 @@ def find_result_set(function_name, input_evaluated):
       This function will always extract the variables.
     - List of result cards.
     """
-    result = []
-    result_converter = default_variable
-
-    for predicate, converter, result_cards in result_sets:
-        if predicate == function_name:
-            if converter:
-                result_converter = converter
-            if result_cards is None:
-                return result_converter, result
-            for card in result_cards:
-                if card not in result:
-                    result.append(card)
-        elif callable(predicate) and predicate(input_evaluated):
-            if converter:
-                result_converter = converter
-            if result_cards is None:
-                return result_converter, result
-            for card in result_cards:
-                if card not in result:
-                    result.append(card)
-
-    return result_converter, result
\ No newline at end of file
+    features = analyze_expression(input_evaluated)
+    positions = result_set_index.matches(function_name, features)
+    result_converter, result = result_set_index.resolve(positions)
+
+    return result_converter, list(result)
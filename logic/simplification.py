@@ -0,0 +1,75 @@
+"""
+Cheap checks of whether sympy.simplify is likely to shorten an expression,
+so that answers already in their simplest form skip it.
+"""
+import itertools
+
+import numpy
+import sympy
+
+# Expressions with at most this many operations are left alone, unless a
+# cheap rewrite changes them
+SIMPLE_OPS = 4
+
+# Rewrites that are cheap next to simplify; if one of them changes the
+# expression without lengthening it, like x*log(x) - x into x*(log(x) - 1),
+# simplify will likely do at least as well
+CHEAP_REWRITES = (sympy.factor_terms, sympy.cancel)
+
+# Points the terms are compared at: positive, so that logarithms and roots
+# are real, and seeded, so that the decision is the same on every run
+SAMPLES = numpy.random.RandomState(0).uniform(0.2, 1.2, size=(8, 8))
+
+
+def combinable_terms(expr):
+    """
+    Whether two terms of a sum combine without looking alike: multiples of
+    each other, like sin(2*x) and sin(x)*cos(x) or log(x**2) and log(x),
+    or adding up to a constant, like sin(x)**2 and cos(x)**2. The terms
+    are compared numerically at SAMPLES, all at once with NumPy.
+    """
+    terms = sympy.Add.make_args(expr)
+    if len(terms) < 2:
+        return False
+    symbols = sorted(expr.free_symbols, key=str)
+    if len(symbols) > len(SAMPLES):
+        return True
+    try:
+        evaluate = sympy.lambdify(symbols, terms, 'numpy')
+        with numpy.errstate(all='ignore'):
+            values = [numpy.broadcast_to(value, SAMPLES.shape[1])
+                      for value in evaluate(*SAMPLES[:len(symbols)])]
+    except Exception:
+        # Something NumPy can't evaluate; let simplify decide
+        return True
+
+    for (i, a), (j, b) in itertools.combinations(enumerate(values), 2):
+        with numpy.errstate(all='ignore'):
+            ratio = a / b
+        if constant(ratio) and not (terms[i] / terms[j]).is_number:
+            return True
+        if constant(a + b) and not (terms[i] + terms[j]).is_number:
+            return True
+    return False
+
+
+def constant(values):
+    return (numpy.all(numpy.isfinite(values)) and
+            numpy.allclose(values, values[0], rtol=1e-9, atol=1e-12))
+
+
+def likely_to_shrink(expr):
+    """Guess, cheaply, whether sympy.simplify would shorten ``expr``."""
+    if not isinstance(expr, sympy.Basic):
+        return False
+    ops = sympy.count_ops(expr)
+    for rewrite in CHEAP_REWRITES:
+        try:
+            rewritten = rewrite(expr)
+        except sympy.PolynomialError:
+            continue
+        if rewritten != expr and sympy.count_ops(rewritten) <= ops:
+            return True
+    if ops <= SIMPLE_OPS:
+        return False
+    return combinable_terms(expr)
@@ -1,8 +1,10 @@
 import sympy
 import collections
+import queue
+import threading
 from contextlib import contextmanager
 
-from sympy import latex
+from logic.latexcache import latex
 
 
 def functionnames(numterms):
@@ -13,36 +15,55 @@ def functionnames(numterms):
     else:
         return ["f_{}".format(i) for i in range(numterms)]
 
-def replace_u_var(rule, old_u, new_u):
-    d = rule._asdict()
-    for field, val in d.items():
-        if isinstance(val, sympy.Basic):
-            d[field] = val.subs(old_u, new_u)
-        elif isinstance(val, tuple):
-            d[field] = replace_u_var(val, old_u, new_u)
-        elif isinstance(val, list):
-            result = []
-            for item in val:
-                if isinstance(item, tuple):
-                    result.append(replace_u_var(item, old_u, new_u))
-                else:
-                    result.append(item)
-            d[field] = result
-    return rule.__class__(**d)
-
 class Printer(object):
-    def __init__(self):
+    """
+    on_flush -- Optional function called with each new chunk of output as
+    steps are completed. Joining the chunks gives the finalized output.
+    """
+    def __init__(self, on_flush=None):
         self.lines = []
         self.level = 0
+        self.on_flush = on_flush
+        self._flushed = 0
+        self.renames = []
 
     def append(self, text):
         self.lines.append(self.level * "\t" + text)
 
+    def flush(self):
+        if not self.on_flush or self._flushed == len(self.lines):
+            return
+        chunk = "\n".join(self.lines[self._flushed:])
+        if self._flushed:
+            chunk = "\n" + chunk
+        self._flushed = len(self.lines)
+        self.on_flush(chunk)
+
     def finalize(self):
+        self.flush()
         return "\n".join(self.lines)
 
+    def rename(self, math):
+        """Apply the renames of the enclosing renamed() blocks to ``math``."""
+        if self.renames and isinstance(math, sympy.Basic):
+            for old, new in self.renames:
+                math = math.xreplace({old: new})
+        return math
+
+    @contextmanager
+    def renamed(self, old, new):
+        """
+        Show ``old`` as ``new`` in the math formatted within the block, e.g.
+        a dummy variable as u. ``old`` is as it's shown outside the block.
+        """
+        self.renames.append((old, new))
+        try:
+            yield
+        finally:
+            self.renames.pop()
+
     def format_math(self, math):
-        return str(math)
+        return str(self.rename(math))
 
     def format_math_display(self, math):
         return self.format_math(math)
@@ -57,23 +78,24 @@ class Printer(object):
     def new_step(self):
         yield self.level
         self.lines.append('\n')
+        self.flush()
 
 class LaTeXPrinter(Printer):
     def format_math(self, math):
-        return latex(math)
+        return latex(self.rename(math), 'printer')
 
 class HTMLPrinter(LaTeXPrinter):
-    def __init__(self):
-        super(HTMLPrinter, self).__init__()
+    def __init__(self, on_flush=None):
+        super(HTMLPrinter, self).__init__(on_flush)
         self.lines = ['<ol id="changedisplaytonone">']
 
     def format_math(self, math):
         return '<script type="math/tex; mode=inline">{}</script>'.format(
-            latex(math))
+            latex(self.rename(math), 'printer'))
 
     def format_math_display(self, math):
         if not isinstance(math, str):
-            math = latex(math)
+            math = latex(self.rename(math), 'printer_display')
         return '<script type="math/tex; mode=display">{}</script>'.format(
             math)
 
@@ -90,6 +112,7 @@ class HTMLPrinter(LaTeXPrinter):
         self.lines.append(' ' * 4 * self.level + '<li>')
         yield self.level
         self.lines.append(' ' * 4 * self.level + '</li>')
+        self.flush()
 
     @contextmanager
     def new_collapsible(self):
@@ -107,3 +130,36 @@ class HTMLPrinter(LaTeXPrinter):
 
     def append_header(self, text):
         self.lines.append(' ' * 4 * (self.level + 1) + '<h2>{}</h2>'.format(text))
+
+
+def stream_steps(print_steps, *args):
+    """
+    Call ``print_steps(*args, on_flush=...)`` in a thread and yield the
+    chunks of output as its printer completes steps. Returns what
+    print_steps returned.
+
+    Only the printing is incremental: the step printers find the whole
+    rule tree before printing the first step, so the first chunk still
+    waits for the full search.
+    """
+    chunks = queue.Queue()
+    done = object()
+    result = []
+
+    def run():
+        try:
+            result.append(print_steps(*args, on_flush=chunks.put))
+        except BaseException as e:
+            chunks.put(e)
+        finally:
+            chunks.put(done)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    while True:
+        chunk = chunks.get()
+        if chunk is done:
+            return result[0] if result else None
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield chunk
@@ -0,0 +1,151 @@
+import hashlib
+import sqlite3
+import threading
+
+import sympy
+
+from logic.stepprinter import stream_steps
+
+
+class Partial(str):
+    """Steps cut short, e.g. by a time budget: shown, but not stored."""
+
+
+class StepStore(object):
+    """
+    Persistent store for step-by-step HTML, kept in a sqlite database.
+
+    Entries are keyed on the kind of steps (e.g. 'diffsteps'), the srepr of
+    the expression and the symbol. Each entry records the printer version it
+    was rendered with, and entries from another version are ignored.
+    """
+    TABLE = 'logic_step_html'
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        if not self._initialized:
+            with self._lock:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS {} ('
+                    'key TEXT PRIMARY KEY, version TEXT NOT NULL, '
+                    'html TEXT NOT NULL)'.format(self.TABLE))
+                connection.commit()
+                self._initialized = True
+        return connection
+
+    def key(self, kind, expr, symbol):
+        text = '\0'.join((kind, sympy.srepr(expr), sympy.srepr(symbol)))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, kind, expr, symbol, version):
+        connection = self.connect()
+        try:
+            row = connection.execute(
+                'SELECT html FROM {} WHERE key = ? AND version = ?'.format(
+                    self.TABLE),
+                (self.key(kind, expr, symbol), version)).fetchone()
+        finally:
+            connection.close()
+        return row[0] if row else None
+
+    def set(self, kind, expr, symbol, version, html):
+        connection = self.connect()
+        try:
+            connection.execute(
+                'INSERT OR REPLACE INTO {} (key, version, html) '
+                'VALUES (?, ?, ?)'.format(self.TABLE),
+                (self.key(kind, expr, symbol), version, html))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def clear(self):
+        connection = self.connect()
+        try:
+            connection.execute('DELETE FROM {}'.format(self.TABLE))
+            connection.commit()
+        finally:
+            connection.close()
+
+
+step_store = None
+
+
+def full_version(version):
+    return '{}:sympy-{}'.format(version, sympy.__version__)
+
+
+def configure(path):
+    """Use the sqlite database at ``path``, or disable the store if None."""
+    global step_store
+    step_store = StepStore(path) if path else None
+    return step_store
+
+
+def cached_steps(kind, version, expr, symbol, compute):
+    """
+    Return the stored HTML for ``expr`` and ``symbol``, calling
+    ``compute(expr, symbol)`` and storing its result on a miss, unless it
+    is Partial.
+    """
+    store = step_store
+    if store is None:
+        return compute(expr, symbol)
+
+    version = full_version(version)
+    try:
+        html = store.get(kind, expr, symbol, version)
+    except sqlite3.Error:
+        return compute(expr, symbol)
+    if html is not None:
+        return html
+
+    html = compute(expr, symbol)
+    if isinstance(html, Partial):
+        return html
+    try:
+        store.set(kind, expr, symbol, version, html)
+    except sqlite3.Error:
+        pass
+    return html
+
+
+def stream_cached_steps(kind, version, expr, symbol, print_steps):
+    """
+    Like cached_steps, but yields the HTML in chunks as ``print_steps``
+    prints steps (after finding all of them, see stream_steps). Stored
+    HTML is yielded as a single chunk.
+    """
+    store = step_store
+    version = full_version(version)
+    if store is not None:
+        try:
+            html = store.get(kind, expr, symbol, version)
+        except sqlite3.Error:
+            html = None
+        if html is not None:
+            yield html
+            return
+
+    chunks = []
+    steps = stream_steps(print_steps, expr, symbol)
+    while True:
+        try:
+            chunk = next(steps)
+        except StopIteration as stop:
+            html = stop.value
+            break
+        chunks.append(chunk)
+        yield chunk
+
+    if store is not None and not isinstance(html, Partial):
+        try:
+            store.set(kind, expr, symbol, version, ''.join(chunks))
+        except sqlite3.Error:
+            pass
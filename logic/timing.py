@@ -0,0 +1,65 @@
+"""
+Time the stages of a request, for the Server-Timing header.
+
+Stages are only timed inside collect(), so outside a request (or with the
+header turned off) stage() costs a context variable lookup. Stages may
+nest, like the latex calls inside a card, and a stage that runs several
+times adds up.
+"""
+import contextlib
+import contextvars
+import time
+
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+class Timings(object):
+    """Total seconds and number of runs of each stage, in first-run order."""
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds):
+        total, count = self.stages.get(name, (0, 0))
+        self.stages[name] = (total + seconds, count + 1)
+
+    def milliseconds(self):
+        return {name: round(total * 1000, 3)
+                for name, (total, _) in self.stages.items()}
+
+    def header(self):
+        """The value of a Server-Timing header with every stage."""
+        metrics = []
+        for name, (total, count) in self.stages.items():
+            metric = '{};dur={:.2f}'.format(name, total * 1000)
+            if count > 1:
+                metric += ';desc="{} calls"'.format(count)
+            metrics.append(metric)
+        return ', '.join(metrics)
+
+
+@contextlib.contextmanager
+def collect():
+    """Time the stages run in this block; yields their Timings."""
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time this block as the stage ``name``: a token of letters, digits and
+    ``-_.``, as Server-Timing needs.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
@@ -1,17 +1,57 @@
 from __future__ import division
 import collections
+import contextlib
+import contextvars
+import threading
 import traceback
 import sys
 import ast
 import re
+import types
 from io import StringIO
 import sympy
 
+from logic.latexcache import latex
+from logic.timing import stage
+
 OTHER_SYMPY_FUNCTIONS = ('sqrt',)
 
 Arguments = collections.namedtuple('Arguments', 'function args kwargs')
 
 
+def _build_sympy_namespace():
+    namespace = {}
+    exec("from sympy import *", namespace)
+    return types.MappingProxyType(namespace)
+
+# Built once per process; requests get a Namespace layered on top of it
+SYMPY_NAMESPACE = _build_sympy_namespace()
+
+
+class Namespace(dict):
+    """
+    Names for one evaluation, layered over a read-only template.
+
+    Lookups fall through to the template and writes only go to this dict, so
+    building one is free and requests cannot see each other's names. This is
+    a dict subclass because eval() requires its globals to be a dict.
+    """
+    def __init__(self, template=SYMPY_NAMESPACE):
+        super(Namespace, self).__init__()
+        self.template = template
+
+    def __missing__(self, name):
+        return self.template[name]
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.template
+
+    def get(self, name, default=None):
+        if dict.__contains__(self, name):
+            return dict.__getitem__(self, name)
+        return self.template.get(name, default)
+
+
 class Eval(object):
     def __init__(self, namespace={}):
         self._namespace = namespace
@@ -22,9 +62,13 @@ class Eval(object):
     def set(self, name, value):
         self._namespace[name] = value
 
-    def eval_node(self, node):
+    def eval_node(self, node, bindings=None):
+        namespace = self._namespace
+        if bindings:
+            namespace = Namespace(self._namespace)
+            namespace.update(bindings)
         tree = ast.fix_missing_locations(ast.Expression(node))
-        return eval(compile(tree, '<string>', 'eval'), self._namespace)
+        return eval(compile(tree, '<string>', 'eval'), namespace)
 
     def eval(self, x, use_none_for_exceptions=False, repr_expression=True):
         globals = self._namespace
@@ -42,9 +86,7 @@ class Eval(object):
                 s += '\n' + t
                 z = None
 
-            try:
-                old_stdout = sys.stdout
-                sys.stdout = StringIO()
+            with captured_stdout() as output:
                 eval(compile(s, '', 'exec', division.compiler_flag), globals, globals)
 
                 if not z is None:
@@ -56,10 +98,7 @@ class Eval(object):
                     r = ''
 
                 if repr_expression:
-                    sys.stdout.seek(0)
-                    r = sys.stdout.read() + r
-            finally:
-                sys.stdout = old_stdout
+                    r = output.getvalue() + r
             return r
         except:
             if use_none_for_exceptions:
@@ -73,6 +112,52 @@ class Eval(object):
             return s
 
 
+# Where print() in the code being evaluated writes, see captured_stdout
+_captured = contextvars.ContextVar('captured_stdout', default=None)
+_install_lock = threading.Lock()
+
+
+class StdoutProxy(object):
+    """
+    Stands in for sys.stdout, writing to the buffer of the current context
+    if there is one and to the stream it replaced otherwise.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def target(self):
+        buffer = _captured.get()
+        return self.stream if buffer is None else buffer
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def captured_stdout():
+    """
+    Collect what is printed in the current thread (or context) into a
+    StringIO, leaving other threads' output alone. Installs a StdoutProxy
+    as sys.stdout the first time, instead of swapping sys.stdout per call.
+    """
+    if not isinstance(sys.stdout, StdoutProxy):
+        with _install_lock:
+            if not isinstance(sys.stdout, StdoutProxy):
+                sys.stdout = StdoutProxy(sys.stdout)
+    buffer = StringIO()
+    token = _captured.set(buffer)
+    try:
+        yield buffer
+    finally:
+        _captured.reset(token)
+
+
 class LatexVisitor(ast.NodeVisitor):
     EXCEPTIONS = {'integrate': sympy.Integral, 'diff': sympy.Derivative}
     formatters = {}
@@ -99,7 +184,7 @@ class LatexVisitor(ast.NodeVisitor):
         # Only apply to lowercase names (i.e. functions, not classes)
         if fname in self.__class__.EXCEPTIONS:
             node.func.id = self.__class__.EXCEPTIONS[fname].__name__
-            self.latex = sympy.latex(self.evaluator.eval_node(node))
+            self.latex = latex(self.evaluator.eval_node(node), 'input')
         else:
             result = self.format(fname, node)
             if result:
@@ -113,26 +198,27 @@ class LatexVisitor(ast.NodeVisitor):
                     if isinstance(arg, ast.Call) and getattr(arg.func, 'id', None) and arg.func.id[0].lower() == arg.func.id[0]:
                         latexes.append(self.visit_Call(arg))
                     else:
-                        latexes.append(sympy.latex(
-                            self.evaluator.eval_node(arg)))
+                        latexes.append(latex(
+                            self.evaluator.eval_node(arg), 'input'))
 
                 buffer.append(', '.join(latexes))
                 buffer.append(')')
 
                 self.latex = ''.join(buffer)
             else:
-                self.latex = sympy.latex(self.evaluator.eval_node(node))
+                self.latex = latex(self.evaluator.eval_node(node), 'input')
         return self.latex
 
 
 @LatexVisitor.formats_function('rsolve')
 def format_rsolve(node, visitor):
-    recurrence = sympy.latex(
-        sympy.Eq(visitor.evaluator.eval_node(node.args[0]), 0))
+    recurrence = latex(
+        sympy.Eq(visitor.evaluator.eval_node(node.args[0]), 0), 'input')
     if len(node.args) == 3:
         conds = visitor.evaluator.eval_node(node.args[2])
         initconds = '\\\\\n'.join(
-            '&' + sympy.latex(sympy.Eq(eqn, val)) for eqn, val in conds.items())
+            '&' + latex(sympy.Eq(eqn, val), 'input')
+            for eqn, val in conds.items())
         text = r'&\mathrm{Solve~the~recurrence~}' + recurrence + r'\\'
         condstext = r'&\mathrm{with~initial~conditions}\\'
         return r'\begin{align}' + text + condstext + initconds + r'\end{align}'
@@ -147,7 +233,7 @@ def format_diophantine(node, visitor):
         klass = sympy.Sum
     else:
         klass = sympy.Product
-    return sympy.latex(klass(*map(visitor.evaluator.eval_node, node.args)))
+    return latex(klass(*map(visitor.evaluator.eval_node, node.args)), 'input')
 
 
 @LatexVisitor.formats_function('help')
@@ -199,7 +285,7 @@ def topcall(string):
 
 def arguments(string_or_node, evaluator):
     node = None
-    if not isinstance(string_or_node, ast.Call):
+    if not isinstance(string_or_node, ast.AST):
         a = TopCallVisitor()
         a.visit(ast.parse(string_or_node))
 
@@ -226,6 +312,55 @@ def arguments(string_or_node, evaluator):
     return None
 
 
+# Top-level calls left unevaluated when parsing the input: their result
+# cards compute them (which can take long) in requests of their own
+DEFERRED_CALLS = {'integrate': sympy.Integral}
+
+
+def evaluate_input(string, evaluator):
+    """
+    Evaluate stringified input in a single pass.
+
+    The arguments of the top-level call are evaluated once, and the input is
+    then evaluated with the call's arguments bound to those values instead
+    of being evaluated again. If the input is a call in DEFERRED_CALLS, it
+    evaluates to the unevaluated form instead.
+
+    Returns the Arguments of the top-level call and the evaluated input.
+    """
+    tree = ast.parse(string, mode='eval')
+    visitor = TopCallVisitor()
+    visitor.visit(tree)
+    node = visitor.call
+
+    if not node:
+        return None, evaluator.eval_node(tree.body)
+
+    with stage('arguments'):
+        result = arguments(node, evaluator)
+    bindings = {}
+
+    def bind(value, node):
+        name = '__arg{}__'.format(len(bindings))
+        bindings[name] = value
+        return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+
+    # Starred arguments and **kwargs don't map back onto single values
+    if (isinstance(node, ast.Call) and
+            not any(isinstance(arg, ast.Starred) for arg in node.args) and
+            all(keyword.arg for keyword in node.keywords)):
+        node.args = [bind(value, arg)
+                     for value, arg in zip(result.args or [], node.args)]
+        for keyword in node.keywords:
+            keyword.value = bind(result.kwargs[keyword.arg], keyword.value)
+        if (node is tree.body and not node.keywords and
+                isinstance(node.func, ast.Name) and
+                node.func.id in DEFERRED_CALLS):
+            node.func = bind(DEFERRED_CALLS[node.func.id], node.func)
+
+    return result, evaluator.eval_node(tree.body, bindings)
+
+
 re_calls = re.compile(
     r'(Integer|Symbol|Float|Rational)\s*\([\'\"]?([a-zA-Z0-9\.]+)[\'\"]?\s*\)')
 
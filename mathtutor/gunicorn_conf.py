@@ -0,0 +1,61 @@
+"""
+Gunicorn settings, used by the Procfile:
+
+    gunicorn -c mathtutor/gunicorn_conf.py mathtutor.wsgi
+
+The application is loaded in the master process (preload_app). SymPy, the
+card tables and, unless CHATBOT_LOAD is 'lazy', the chatbot are then loaded
+there once, and the workers share those pages copy-on-write. Set
+GUNICORN_PRELOAD=0 to load them in each worker instead. Either way the
+warm-up runs once per process, from the hooks below, and never starts a
+thread in the master.
+
+GUNICORN_THREADS sets the number of threads per worker (the gthread
+worker class when more than one); the math engine is safe to run in
+threads. Off the main thread, SymPy can only be stopped at the integral
+steps budget by running it in the INTSTEPS_WORKER_PROCESSES.
+"""
+import gc
+import os
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+threads = int(os.environ.get('GUNICORN_THREADS', '1'))
+
+# The hooks warm up, not the import of mathtutor.wsgi
+os.environ['WSGI_WARM_UP'] = '0'
+
+
+def warm_up():
+    from app import views
+    from mathtutor import settings
+
+    views.warm_up_math()
+    if settings.CHATBOT_LOAD != 'lazy':
+        # Not in a background thread: the workers are forked from this one
+        views.load_chatbot()
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    # Importing mathtutor.wsgi already imported SymPy and built the card
+    # tables; warm them up and load the rest, then move everything loaded so
+    # far out of the collector's reach, so that collections in the workers
+    # don't write to (and so copy) the shared pages
+    warm_up()
+    gc.collect()
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    from app import views
+    from logic import intsteps
+
+    if not worker.cfg.preload_app:
+        # The math engine, and the chatbot in the background if configured
+        views.warm_up()
+    # Start the worker pools' fork server here rather than on the first
+    # request; never in the master, as it can't be shared through fork
+    for pool in (views.card_pool, intsteps.worker_pool):
+        if pool is not None:
+            pool.start()
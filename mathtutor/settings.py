@@ -23,6 +23,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,6 +59,63 @@ DATABASES = {
     }
 }
 
+# Derivative and integral steps are stored across restarts in this sqlite
+# file, which is separate from DATABASES so that any database backend works;
+# set to None to disable
+STEP_STORE_PATH = os.path.join(BASE_DIR, 'steps.sqlite3')
+
+# Number of worker processes cards are evaluated in, with per-call limits
+# in seconds and bytes; 0 evaluates cards in the web worker itself
+CARD_WORKER_PROCESSES = 0
+CARD_WORKER_TIMEOUT = 30
+CARD_WORKER_CPU_LIMIT = 30
+CARD_WORKER_MEMORY_LIMIT = 1024 * 1024 * 1024
+
+# Seconds the integral steps card may spend on the steps before showing
+# what it found so far, and the most a card's budget parameter may ask
+# for; None for no limit
+INTSTEPS_BUDGET = 10
+INTSTEPS_MAX_BUDGET = 30
+
+# Worker processes that keep the budget in threads other than the main one
+# (gthread workers, runserver, streamed steps), where SymPy can't be
+# interrupted otherwise; 0 leaves it unlimited there (see logic.intsteps)
+INTSTEPS_WORKER_PROCESSES = 1
+
+# Most (lower, upper) pairs one request to /definite_integrals/ may ask for
+DEFINITE_INTEGRALS_MAX_BOUNDS = 1000
+
+# Send the time spent in each stage of a request (parsing, each card, LaTeX,
+# rendering) in a Server-Timing header, which shows anyone what the server
+# spends its time on, so only in development; SERVER_TIMING_LOG logs it as a
+# JSON line to the app.middleware logger instead
+SERVER_TIMING = DEBUG
+SERVER_TIMING_LOG = False
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'app.middleware': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+# When to load the chatbot model: 'lazy' on the first chatbot message, or
+# 'background' in a thread when the server starts (/readyz waits for it)
+CHATBOT_LOAD = 'lazy'
+
+# Chatbot messages arriving within this many seconds of each other share
+# one forward pass, up to CHATBOT_BATCH_SIZE messages; 0 disables batching
+CHATBOT_BATCH_WINDOW = 0
+CHATBOT_BATCH_SIZE = 32
+
+# Chatbot word tokenizer: 'nltk' (needs the punkt data), 'regex', or 'auto'
+# for nltk when its data is installed
+CHATBOT_TOKENIZER = 'auto'
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -6,3 +6,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mathtutor.settings')
 
 application = get_wsgi_application()
 
+# mathtutor/gunicorn_conf.py turns this off and warms up from its hooks,
+# before or after the fork as appropriate
+if os.environ.get('WSGI_WARM_UP', '1') != '0':
+    from app.views import warm_up
+
+    warm_up()
@@ -29,6 +29,9 @@ var Card = (function() {
         if (error == null) {
             error = $.proxy(this.evaluateError, this);
         }
+        if (Card.useStreaming && this.canStream()) {
+            return this.evaluateStream(finished, error);
+        }
         if (typeof this.card_name !== "undefined") {
             var url = '/card/' + this.card_name;
             var parms = {
@@ -45,6 +48,68 @@ var Card = (function() {
         return result;
     };
 
+    Card.prototype.canStream = function() {
+        return this.card_name === 'intsteps' || this.card_name === 'diffsteps';
+    };
+
+    // Reads the newline delimited JSON from /card/<name>/stream and shows
+    // the steps as they arrive
+    Card.prototype.evaluateStream = function(finished, error) {
+        var deferred = new $.Deferred();
+        var xhr = new XMLHttpRequest();
+        var parms = {
+            variable: this.variable,
+            expression: this.expr,
+        };
+        $.extend(parms, this.parameterValues);
+
+        var card = this;
+        var received = 0;
+        var buffer = '';
+        var html = '';
+        var failed = null;
+        var read = function() {
+            buffer += xhr.responseText.substring(received);
+            received = xhr.responseText.length;
+            var lines = buffer.split('\n');
+            buffer = lines.pop();
+            $.each(lines, function(i, line) {
+                if (!line) {
+                    return;
+                }
+                var data = JSON.parse(line);
+                if (typeof data.output !== "undefined") {
+                    html += data.output;
+                    card.result.html($("<div/>").addClass('steps').html(html));
+                    card.element.show();
+                    MathJax.Hub.Queue(["Typeset", MathJax.Hub]);
+                }
+                else if (typeof data.error !== "undefined") {
+                    failed = data;
+                }
+            });
+        };
+
+        xhr.open('GET', '/card/' + this.card_name + '/stream?' + $.param(parms));
+        xhr.onprogress = read;
+        xhr.onload = function() {
+            read();
+            if (failed) {
+                finished(failed);
+            }
+            else {
+                finished({output: '<div class="steps">' + html + '</div>'});
+            }
+            deferred.resolve();
+        };
+        xhr.onerror = function() {
+            error();
+            deferred.reject();
+        };
+        xhr.send();
+        return deferred;
+    };
+
     Card.prototype.evaluateFinished = function(data) {
         if (data) {
             if (typeof data.output !== "undefined") {
@@ -252,6 +317,71 @@ var Card = (function() {
         return card;
     };
 
+    // Set to true to show step cards as their steps are printed (the steps
+    // are all found before the first one is sent)
+    Card.useStreaming = false;
+
+    // Set to true to evaluate the cards of a page with one request to
+    // /cards/ per expression instead of one request per card
+    Card.useBatch = false;
+
+    Card.evaluateBatch = function(cards) {
+        var groups = {};
+        $.each(cards, function(i, card) {
+            if (typeof card.card_name === "undefined") {
+                return;
+            }
+            var key = card.variable + '\n' + card.expr;
+            if (!groups.hasOwnProperty(key)) {
+                groups[key] = [];
+            }
+            groups[key].push(card);
+        });
+
+        var requests = [];
+        $.each(groups, function(key, group) {
+            var deferred = $.ajax({
+                type: 'POST',
+                url: '/cards/',
+                data: JSON.stringify({
+                    variable: group[0].variable,
+                    expression: group[0].expr,
+                    cards: $.map(group, function(card) {
+                        return {
+                            name: card.card_name,
+                            parameters: card.parameterValues
+                        };
+                    })
+                }),
+                contentType: 'application/json',
+                dataType: 'json'
+            });
+            deferred.done(function(data) {
+                $.each(group, function(i, card) {
+                    if (data.cards) {
+                        card.evaluateFinished(data.cards[i]);
+                    }
+                    else {
+                        card.evaluateFinished({error: data.error});
+                    }
+                });
+            });
+            deferred.fail(function() {
+                $.each(group, function(i, card) {
+                    card.evaluateError();
+                });
+            });
+            requests.push(deferred);
+        });
+
+        if (!requests.length) {
+            var result = new $.Deferred();
+            result.reject();
+            return result;
+        }
+        return $.when.apply($, requests);
+    };
+
     Card.loadNewCard = function(el) {
         var card = Card.fromCardEl(el);
         var loader = $("<div/>").addClass('loader');
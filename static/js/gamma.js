@@ -40,15 +40,26 @@ function setupExamples() {
 function evaluateCards() {
     var deferred = new $.Deferred();
     var requests = [];
+    var cards = [];
     $('.result_card').each(function() {
         var card = Card.fromCardEl($(this));
         card.initSpecificFunctionality();
+        if (Card.useBatch) {
+            cards.push(card);
+            return;
+        }
         // deferred if can evaluate, false otherwise
         var result = card.evaluate();
         if (!(result.state() == "rejected")) {
             requests.push(result);
         }
     });
+    if (Card.useBatch) {
+        var result = Card.evaluateBatch(cards);
+        if (!(result.state() == "rejected")) {
+            requests.push(result);
+        }
+    }
     $.when.apply($, requests).then(function() {
         deferred.resolve();
     });